@@ -0,0 +1,69 @@
+import argparse
+import os
+import time
+
+import numpy as np
+
+from src.db import INDEX_JOIN, StorageDB
+from src.dedup import find_duplicates
+from src.index import CompositeIndex
+
+
+def dump_features(db: StorageDB, path: str) -> tuple[list[str], np.ndarray]:
+    """
+    Stream the features of the indexed images, in index row order, into a .npy file, and return
+    their ids and the memory-mapped features.
+    """
+    (n_rows,) = db.conn.execute(f"SELECT COUNT(*) {INDEX_JOIN}").fetchone()
+    img_ids: list[str] = []
+    features = np.empty((0, 0), dtype=np.float32)
+    for batch_ids, batch in db.iter_features():
+        if len(img_ids) + len(batch_ids) > n_rows:
+            raise RuntimeError("the database changed while the features were read")
+        if not img_ids:
+            features = np.lib.format.open_memmap(
+                path, mode="w+", dtype=np.float32, shape=(n_rows, batch.shape[1])
+            )
+        features[len(img_ids) : len(img_ids) + len(batch_ids)] = batch
+        img_ids.extend(batch_ids)
+    if len(img_ids) != n_rows:
+        raise RuntimeError("the database changed while the features were read")
+    return img_ids, features
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Find clusters of near-duplicate images and store them in the duplicates table."
+    )
+    parser.add_argument("--db-path", type=str, default="./storage.db")
+    parser.add_argument("--threshold", type=float, default=0.95, help="CLIP similarity threshold")
+    parser.add_argument("--tile-size", type=int, default=4096)
+    parser.add_argument("--n-workers", type=int, default=None, help="defaults to the core count")
+    args = parser.parse_args()
+
+    db = StorageDB(args.db_path)
+    # NOTE the snapshot memory-maps the features, so they do not have to fit in memory; without
+    # an up-to-date one, they are streamed to a memory-mapped file rather than loaded
+    index = CompositeIndex.load(f"{args.db_path}.index", db.watermark())
+    features_path = f"{args.db_path}.features.npy"
+    if index is not None:
+        img_ids, features = index.img_ids, index.features
+    else:
+        img_ids, features = dump_features(db, features_path)
+    init = time.perf_counter()
+    clusters = find_duplicates(features, args.threshold, args.tile_size, args.n_workers)
+    clusters = [[img_ids[i] for i in cluster] for cluster in clusters]
+    db.save_duplicates(clusters)
+    db.close()
+    if index is None:
+        del features
+        os.remove(features_path)
+    n_duplicates = sum(len(cluster) - 1 for cluster in clusters)
+    print(
+        f"found {len(clusters)} clusters ({n_duplicates} redundant images) among "
+        f"{len(img_ids)} images in {time.perf_counter() - init:.2f} s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -19,8 +19,10 @@ def process_batch(
     clip_extractor: Callable,
     db: StorageDB,
     small_img_height: int = 400,
+    in_place: bool = False,
 ) -> None:
-    img_ids = []
+    images = []
+    paths = []
     imgs = []
     for img_path, img_bytes, extension in batch:
         try:
@@ -43,15 +45,15 @@ def process_batch(
         except Exception as exc:
             print(f"image file {img_path} failed to open: {exc}")
             continue
-        img_id = db.insert_image(img_bytes, small_img_buffer.read(), extension, timestamp)
-        img_ids.append(img_id)
+        images.append((img_bytes, small_img_buffer.read(), extension, timestamp))
+        paths.append(img_path if in_place else None)
         imgs.append(img)
 
+    img_ids = db.insert_images(images, paths)
     tags = ram_extractor(imgs)
     features = clip_extractor(imgs)
-    for img_id, tag, feat in zip(img_ids, tags, features):
-        db.insert_tags(img_id, tag)
-        db.insert_features(img_id, feat)
+    db.insert_tags_many(img_ids, tags)
+    db.insert_features_many(img_ids, features)
     db.commit()
 
 
@@ -62,10 +64,40 @@ def main():
     parser.add_argument("--batch-size", type=int, default=16)
     parser.add_argument("--model-path", type=str, default="./models/ram_swin_large_14m.pth")
     parser.add_argument("--small-img-height", type=int, default=400)
+    parser.add_argument(
+        "--synchronous",
+        type=str,
+        default="NORMAL",
+        help="SQLite synchronous pragma, OFF speeds up bulk loads at the risk of corruption",
+    )
+    parser.add_argument("--journal-mode", type=str, default="WAL", help="SQLite journal_mode")
+    parser.add_argument(
+        "--blob-store",
+        action="store_true",
+        help="store images and thumbnails as files in <db-path>.blobs instead of in the database",
+    )
+    parser.add_argument(
+        "--in-place",
+        action="store_true",
+        help="reference the original files where they are instead of copying them",
+    )
+    parser.add_argument(
+        "--thumbnail-pack",
+        action="store_true",
+        help="also append thumbnails to <db-path>.thumbs, from which the app serves them",
+    )
     args = parser.parse_args()
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    db = StorageDB(args.db_path)
+    db = StorageDB(
+        args.db_path,
+        synchronous=args.synchronous,
+        journal_mode=args.journal_mode,
+        blob_dir=f"{args.db_path}.blobs" if args.blob_store else None,
+        pack_thumbnails=args.thumbnail_pack,
+    )
+    if args.thumbnail_pack:
+        db.backfill_thumbnail_pack()
     ram_extractor = create_ram_extractor(args.model_path, device=device)
     clip_extractor, _ = create_clip_extractor(device)
 
@@ -80,7 +112,9 @@ def main():
                 img_bytes = f.read()
             batch.append((img_path, img_bytes, extension))
             if len(batch) >= args.batch_size:
-                process_batch(batch, ram_extractor, clip_extractor, db, args.small_img_height)
+                process_batch(
+                    batch, ram_extractor, clip_extractor, db, args.small_img_height, args.in_place
+                )
                 batch = []
                 print(
                     f"processed {i}/{len(file_paths)} images in {time.perf_counter() - init:.2f} s"
@@ -88,7 +122,9 @@ def main():
                 init = time.perf_counter()
 
         if batch:
-            process_batch(batch, ram_extractor, clip_extractor, db)
+            process_batch(
+                batch, ram_extractor, clip_extractor, db, args.small_img_height, args.in_place
+            )
 
         print("finished")
 
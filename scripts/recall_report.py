@@ -0,0 +1,73 @@
+import argparse
+import time
+
+import numpy as np
+
+from src.db import StorageDB
+from src.hnsw import HNSWIndex
+from src.index import BinaryEngine
+from src.ivf import IVFIndex
+from src.pq import PQEngine
+from src.sq import Int8Engine
+
+
+def build_engine(name: str, db: StorageDB, db_path: str, index, rerank: int):
+    if name == "int8":
+        return Int8Engine.from_db(db, index, rerank=rerank)
+    if name == "pq":
+        return PQEngine.from_db(db, index, rerank=rerank)
+    if name == "binary":
+        return BinaryEngine.from_features(index.features, rerank=rerank or 1000)
+    if name == "ivf":
+        return IVFIndex.load_or_train(f"{db_path}.ivf.npz", index.features, db.watermark())
+    if name == "hnsw":
+        return HNSWIndex.load_or_build(f"{db_path}.hnsw.npz", index.features, index.img_ids)
+    raise ValueError(f"unknown engine {name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the results of an approximate CLIP engine with the exact search."
+    )
+    parser.add_argument("--db-path", type=str, default="./storage.db")
+    parser.add_argument(
+        "--engine", type=str, default="int8", choices=["int8", "pq", "binary", "ivf", "hnsw"]
+    )
+    parser.add_argument(
+        "--rerank", type=int, default=200, help="exact re-ranking candidates (int8/pq, 0 = off)"
+    )
+    parser.add_argument("--n-queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    db = StorageDB(args.db_path, read_mode=True)
+    index = db.create_index()
+    engine = build_engine(args.engine, db, args.db_path, index, args.rerank)
+
+    # NOTE stored images are used as queries, as an image search would
+    rng = np.random.default_rng(args.seed)
+    query_rows = rng.choice(len(index.img_ids), min(args.n_queries, len(index.img_ids)), False)
+    recalls, exact_time, approx_time = [], 0.0, 0.0
+    for row in query_rows:
+        query_feat = index.features[row]
+        init = time.perf_counter()
+        exact = index.find_knn_clip(query_feat, args.top_k)
+        exact_time += time.perf_counter() - init
+        index.clip_engine = engine
+        init = time.perf_counter()
+        approx = index.find_knn_clip(query_feat, args.top_k)
+        approx_time += time.perf_counter() - init
+        index.clip_engine = None
+        recalls.append(len({i for i, _ in exact} & {i for i, _ in approx}) / len(exact))
+
+    n = len(query_rows)
+    print(f"engine: {args.engine}, images: {len(index.img_ids)}, queries: {n}")
+    print(f"recall@{args.top_k}: {np.mean(recalls):.4f} (min {np.min(recalls):.4f})")
+    print(f"exact: {1000 * exact_time / n:.2f} ms/query")
+    print(f"{args.engine}: {1000 * approx_time / n:.2f} ms/query")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
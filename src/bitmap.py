@@ -0,0 +1,238 @@
+"""
+Roaring-style compressed bitmaps of index rows, and boolean tag queries evaluated with them.
+"""
+
+import re
+from typing import Callable, Union
+
+import numpy as np
+
+# NOTE rows are split in chunks of 2 ** 16 by their high bits; as in Roaring, a chunk holding
+# more than ARRAY_MAX rows is stored as a bitset of uint64 words, otherwise as sorted uint16
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+ARRAY_MAX = 4096
+
+
+def _to_words(container: np.ndarray) -> np.ndarray:
+    if container.dtype == np.uint64:
+        return container
+    bits = np.zeros(CHUNK_SIZE, dtype=bool)
+    bits[container] = True
+    return np.packbits(bits, bitorder="little").view(np.uint64)
+
+
+def _to_values(container: np.ndarray) -> np.ndarray:
+    if container.dtype == np.uint16:
+        return container
+    bits = np.unpackbits(container.view(np.uint8), bitorder="little")
+    return np.flatnonzero(bits).astype(np.uint16)
+
+
+def _contains(words: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Whether each of the sorted uint16 values is set in the bitset words."""
+    values = values.astype(np.uint64)
+    return ((words[values >> np.uint64(6)] >> (values & np.uint64(63))) & np.uint64(1)) == 1
+
+
+def _optimize(words: np.ndarray) -> Union[np.ndarray, None]:
+    """Store a bitset result as the cheaper container, or None if it is empty."""
+    cardinality = int(np.unpackbits(words.view(np.uint8)).sum())
+    if cardinality == 0:
+        return None
+    return _to_values(words) if cardinality <= ARRAY_MAX else words
+
+
+class Bitmap:
+    """Set of rows, as a dict from chunk key (row >> CHUNK_BITS) to its container."""
+
+    def __init__(self, containers: dict[int, np.ndarray]):
+        self.containers = containers
+
+    @classmethod
+    def from_rows(cls, rows: np.ndarray) -> "Bitmap":
+        """Build from sorted, unique rows (e.g. a posting list)."""
+        rows = np.asarray(rows, dtype=np.int64)
+        containers = {}
+        splits = np.flatnonzero(np.diff(rows >> CHUNK_BITS)) + 1
+        for chunk in np.split(rows, splits) if len(rows) else []:
+            values = (chunk & (CHUNK_SIZE - 1)).astype(np.uint16)
+            containers[int(chunk[0] >> CHUNK_BITS)] = (
+                values if len(values) <= ARRAY_MAX else _to_words(values)
+            )
+        return cls(containers)
+
+    @classmethod
+    def full(cls, n_rows: int) -> "Bitmap":
+        return cls.from_rows(np.arange(n_rows))
+
+    def __len__(self) -> int:
+        return sum(
+            len(c) if c.dtype == np.uint16 else int(np.unpackbits(c.view(np.uint8)).sum())
+            for c in self.containers.values()
+        )
+
+    def to_rows(self) -> np.ndarray:
+        """Sorted int64 rows."""
+        chunks = [
+            (key << CHUNK_BITS) + _to_values(self.containers[key]).astype(np.int64)
+            for key in sorted(self.containers)
+        ]
+        return np.concatenate([np.empty(0, dtype=np.int64), *chunks])
+
+    def __and__(self, other: "Bitmap") -> "Bitmap":
+        containers = {}
+        for key in self.containers.keys() & other.containers.keys():
+            a, b = self.containers[key], other.containers[key]
+            if a.dtype == np.uint16 and b.dtype == np.uint16:
+                result = np.intersect1d(a, b, assume_unique=True)
+            elif a.dtype == np.uint16:
+                result = a[_contains(b, a)]
+            elif b.dtype == np.uint16:
+                result = b[_contains(a, b)]
+            else:
+                result = _optimize(a & b)
+            if result is not None and len(result):
+                containers[key] = result
+        return Bitmap(containers)
+
+    def __or__(self, other: "Bitmap") -> "Bitmap":
+        containers = {**self.containers, **other.containers}
+        for key in self.containers.keys() & other.containers.keys():
+            a, b = self.containers[key], other.containers[key]
+            if a.dtype == np.uint16 and b.dtype == np.uint16:
+                result = np.union1d(a, b)
+                containers[key] = result if len(result) <= ARRAY_MAX else _to_words(result)
+            else:
+                containers[key] = _to_words(a) | _to_words(b)
+        return Bitmap(containers)
+
+    def __sub__(self, other: "Bitmap") -> "Bitmap":
+        """AND NOT."""
+        containers = {}
+        for key, a in self.containers.items():
+            b = other.containers.get(key)
+            if b is None:
+                result = a
+            elif a.dtype == np.uint16 and b.dtype == np.uint16:
+                result = np.setdiff1d(a, b, assume_unique=True)
+            elif a.dtype == np.uint16:
+                result = a[~_contains(b, a)]
+            else:
+                result = _optimize(a & ~_to_words(b))
+            if result is not None and len(result):
+                containers[key] = result
+        return Bitmap(containers)
+
+
+# NOTE nodes are ("tag", name), ("not", node), ("and", [nodes]) or ("or", [nodes])
+TagQuery = tuple
+
+TOKEN_PATTERN = re.compile(r'\s*(?:(\()|(\))|"([^"]*)"|([^\s()"]+))')
+
+
+def parse_tag_query(text: str) -> TagQuery:
+    """
+    Parse a boolean tag query such as `beach AND dog AND NOT people` or `(cat OR kitten)`.
+    AND, OR and NOT are upper case; NOT binds tightest, then AND, then OR. Consecutive words
+    form one tag ("baseball cap"), and tags can also be double-quoted.
+    """
+    tokens = []
+    pos, after_word = 0, False
+    text = text.strip()
+    while pos < len(text):
+        match = TOKEN_PATTERN.match(text, pos)
+        if match is None:
+            raise ValueError(f"invalid tag query at {text[pos:]!r}")
+        pos = match.end()
+        left, right, quoted, word = match.groups()
+        if left or right:
+            tokens.append(left or right)
+        elif quoted is not None:
+            tokens.append(("tag", quoted))
+        elif word in ("AND", "OR", "NOT"):
+            tokens.append(word)
+        elif after_word:
+            tokens[-1] = ("tag", f"{tokens[-1][1]} {word}")
+        else:
+            tokens.append(("tag", word))
+        after_word = word is not None and word not in ("AND", "OR", "NOT")
+
+    def peek() -> Union[str, TagQuery, None]:
+        return tokens[0] if tokens else None
+
+    def parse_or() -> TagQuery:
+        nodes = [parse_and()]
+        while peek() == "OR":
+            tokens.pop(0)
+            nodes.append(parse_and())
+        return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+    def parse_and() -> TagQuery:
+        nodes = [parse_not()]
+        while peek() == "AND":
+            tokens.pop(0)
+            nodes.append(parse_not())
+        return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+    def parse_not() -> TagQuery:
+        token = tokens.pop(0) if tokens else None
+        if token == "NOT":
+            return ("not", parse_not())
+        if token == "(":
+            node = parse_or()
+            if not tokens or tokens.pop(0) != ")":
+                raise ValueError("unbalanced parentheses in tag query")
+            return node
+        if isinstance(token, tuple):
+            return token
+        raise ValueError(f"unexpected {token or 'end'} in tag query")
+
+    node = parse_or()
+    if tokens:
+        raise ValueError(f"unexpected {tokens[0]} in tag query")
+    return node
+
+
+def match_tag_query(node: TagQuery, tags: set[str]) -> bool:
+    """Whether a single image with the given tags matches a parsed query."""
+    kind = node[0]
+    if kind == "tag":
+        return node[1] in tags
+    if kind == "not":
+        return not match_tag_query(node[1], tags)
+    matches = (match_tag_query(child, tags) for child in node[1])
+    return all(matches) if kind == "and" else any(matches)
+
+
+def evaluate_tag_query(
+    node: TagQuery, tag_bitmap: Callable[[str], Bitmap], universe: Callable[[], Bitmap]
+) -> Bitmap:
+    """
+    Rows matching a parsed query. tag_bitmap gives the rows of a tag (empty if unknown), and
+    universe all rows, which is only needed to negate a query without positive terms.
+    """
+    kind = node[0]
+    if kind == "tag":
+        return tag_bitmap(node[1])
+    if kind == "not":
+        return universe() - evaluate_tag_query(node[1], tag_bitmap, universe)
+    if kind == "or":
+        result = Bitmap({})
+        for child in node[1]:
+            result = result | evaluate_tag_query(child, tag_bitmap, universe)
+        return result
+    # NOTE AND NOT is a difference, and intersections go from the smallest operand
+    positives = [
+        evaluate_tag_query(child, tag_bitmap, universe) for child in node[1] if child[0] != "not"
+    ]
+    negatives = [
+        evaluate_tag_query(child[1], tag_bitmap, universe) for child in node[1] if child[0] == "not"
+    ]
+    positives.sort(key=len)
+    result = positives[0] if positives else universe()
+    for bitmap in positives[1:]:
+        result = result & bitmap
+    for bitmap in negatives:
+        result = result - bitmap
+    return result
@@ -0,0 +1,56 @@
+"""
+Content-addressed file store for image bytes, so that the SQLite database only holds metadata.
+"""
+
+import os
+from typing import Optional
+
+
+class BlobStore:
+    """
+    Files under root, named by the SHA-1 id of their image and sharded by its first two bytes
+    (root/ab/cd/abcd...), so no directory holds more than a few thousand files. Stored paths are
+    relative to root, so the whole tree can be moved along with the database.
+    """
+
+    def __init__(self, root: str, fsync: bool = True):
+        self.root = os.path.abspath(root)
+        self.fsync = fsync
+
+    def relative_path(self, img_id: str, suffix: str = "") -> str:
+        return os.path.join(img_id[:2], img_id[2:4], f"{img_id}{suffix}")
+
+    def resolve(self, path: str) -> str:
+        """Absolute path of a stored path (absolute paths, e.g. referenced originals, are kept)."""
+        return os.path.join(self.root, path)
+
+    def put(self, img_id: str, data: bytes, suffix: str = "") -> str:
+        """Write data unless it is already stored, and return its path relative to root."""
+        path = self.relative_path(img_id, suffix)
+        full_path = self.resolve(path)
+        if os.path.exists(full_path):
+            # NOTE same id, same content
+            return path
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        # NOTE write then rename, so a crash never leaves a truncated file under the final name
+        tmp_path = f"{full_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, full_path)
+        return path
+
+    def get(self, path: str) -> bytes:
+        with open(self.resolve(path), "rb") as f:
+            return f.read()
+
+    def delete(self, path: Optional[str]) -> None:
+        """Remove a stored file; paths outside the store (referenced originals) are left alone."""
+        if path is None or os.path.isabs(path):
+            return
+        try:
+            os.remove(self.resolve(path))
+        except FileNotFoundError:
+            pass
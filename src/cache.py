@@ -0,0 +1,53 @@
+"""
+Thread-safe LRU cache bounded both by number of entries and by total size.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class LRUCache:
+    """
+    Least recently used entries are evicted once there are more than max_entries of them, or
+    once their sizes (given by the caller on put) add up to more than max_bytes.
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 64 << 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self.n_bytes = 0
+        self.hits, self.misses = 0, 0
+        # NOTE app sessions run in threads
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, n_bytes: int) -> None:
+        with self._lock:
+            if key in self.entries:
+                self.n_bytes -= self.entries.pop(key)[1]
+            if n_bytes > self.max_bytes:
+                return
+            self.entries[key] = (value, n_bytes)
+            self.n_bytes += n_bytes
+            while len(self.entries) > self.max_entries or self.n_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.n_bytes -= evicted_bytes
+
+    def clear(self) -> None:
+        with self._lock:
+            self.entries.clear()
+            self.n_bytes = 0
@@ -1,28 +1,186 @@
 import json
+import multiprocessing
 import os
 import sqlite3
-from datetime import datetime
+import threading
+import weakref
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
 from hashlib import sha1
-from typing import Optional
+from typing import Callable, Iterator, Optional, Union
 
 import numpy as np
 
-from src.index import CompositeIndex
+from src.blobstore import BlobStore
+from src.index import TAG_ID_DTYPE, CompositeIndex
+from src.thumbpack import ThumbnailPack
+
+# NOTE every index structure is aligned on this row order
+INDEX_ORDER = "ORDER BY tags.rowid"
+# NOTE serving profile of read connections: memory-map up to 1 GiB of the database file and
+# keep up to 64 MiB of pages cached per connection
+READ_MMAP_SIZE = 1 << 30
+READ_CACHE_KIB = 64 << 10
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+# NOTE rows per tag decoding worker, below which starting processes costs more than it saves
+ROWS_PER_WORKER = 250_000
+
+INDEX_JOIN = (
+    "FROM tags JOIN features ON tags.id = features.id LEFT JOIN images ON tags.id = images.id"
+)
+
+
+def to_naive_utc(timestamp: datetime) -> datetime:
+    """Aware timestamps as naive UTC, naive (EXIF) ones being kept as they are, like to_epoch."""
+    if timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def decode_timestamps(timestamps: list[Optional[str]]) -> np.ndarray:
+    """
+    ISO timestamps (see insert_images) to epoch seconds, missing ones being NO_TIMESTAMP.
+    """
+    # NOTE rows written before timestamps were stored as naive UTC may carry a UTC offset, which
+    # numpy parses with a deprecation warning; those few are converted through datetime
+    timestamps = [
+        "NaT"
+        if not t
+        else to_naive_utc(datetime.fromisoformat(t)).isoformat()
+        if len(t) > 19 and t[-6] in "+-"
+        else t
+        for t in timestamps
+    ]
+    return np.array(timestamps, dtype="datetime64[s]").astype(np.int64)
+
+
+def decode_tag_rows(
+    conn: sqlite3.Connection, lo: int, hi: int
+) -> tuple[list[str], list[str], np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Decode the index rows with tags.rowid in [lo, hi): their ids, tag vocabulary (in order of
+    first appearance), tag ids and offsets (CSR) into that vocabulary, and epoch timestamps.
+    """
+    cur = conn.execute(
+        f"SELECT tags.id, tags, timestamp {INDEX_JOIN} "
+        f"WHERE tags.rowid >= ? AND tags.rowid < ? {INDEX_ORDER}",
+        (lo, hi),
+    )
+    img_ids, timestamps = [], []
+    tag_vocab: dict[str, int] = {}
+    # NOTE flat typed arrays instead of per-image sets; tags are stored deduplicated (see
+    # insert_tags)
+    tag_ids, tag_offsets = array("H"), array("q", [0])
+    for img_id, tags, timestamp in cur:
+        img_ids.append(img_id)
+        timestamps.append(timestamp)
+        tag_ids.extend(tag_vocab.setdefault(tag, len(tag_vocab)) for tag in json.loads(tags))
+        tag_offsets.append(len(tag_ids))
+    timestamps = decode_timestamps(timestamps)
+    return (
+        img_ids,
+        list(tag_vocab),
+        np.frombuffer(tag_ids, dtype=TAG_ID_DTYPE),
+        np.frombuffer(tag_offsets, dtype=np.int64),
+        timestamps,
+    )
+
+
+def _decode_tag_rows_worker(
+    db_path: str, lo: int, hi: int
+) -> tuple[list[str], list[str], np.ndarray, np.ndarray, np.ndarray]:
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        return decode_tag_rows(conn, lo, hi)
+    finally:
+        conn.close()
+
+
+class _ThreadConnection:
+    """Read-only connection of one thread, closed as soon as the thread exits and drops it."""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        # NOTE not relying on the connection being garbage collected, it is part of a reference
+        # cycle (its statement cache) and would stay open until the next collection
+        weakref.finalize(self, conn.close)
 
 
 class StorageDB:
-    def __init__(self, db_path: str, read_mode: bool = False):
+    def __init__(
+        self,
+        db_path: str,
+        read_mode: bool = False,
+        synchronous: str = "NORMAL",
+        journal_mode: str = "WAL",
+        blob_dir: Optional[str] = None,
+        pack_thumbnails: bool = False,
+    ):
+        """
+        synchronous and journal_mode set the pragmas of the write connection. The defaults are
+        safe; a one-off bulk load can use synchronous="OFF" and journal_mode="MEMORY", at the
+        risk of a corrupted database if the machine crashes meanwhile.
+
+        With blob_dir, inserted images and thumbnails are written as files in that directory
+        (see BlobStore) and the database only keeps their paths. Readers resolve these paths
+        against blob_dir, which defaults to db_path + ".blobs".
+
+        With pack_thumbnails, inserted thumbnails are also appended to a ThumbnailPack at
+        db_path + ".thumbs", which retrieve_small_img reads first whenever it exists.
+        """
         db_path = os.path.abspath(db_path)
-        if read_mode:
-            db_path = f"file:{db_path}?mode=ro"
-        self.conn = sqlite3.connect(db_path, check_same_thread=not read_mode, uri=read_mode)
+        self.db_path = db_path
+        self.read_mode = read_mode
+        self.store_blobs = blob_dir is not None
+        self.blob_store = BlobStore(
+            blob_dir or f"{db_path}.blobs", fsync=synchronous.upper() != "OFF"
+        )
+        # NOTE files of deleted images, removed by commit once their rows are gone for good
+        self._deleted_paths: set[str] = set()
+        self.pack_thumbnails = pack_thumbnails and not read_mode
+        pack_path = f"{db_path}.thumbs"
+        self.thumbnail_pack = None
+        if self.pack_thumbnails or os.path.exists(pack_path):
+            self.thumbnail_pack = ThumbnailPack(
+                pack_path,
+                read_mode=not self.pack_thumbnails,
+                fsync=synchronous.upper() != "OFF",
+            )
+        # NOTE in read mode every thread (e.g. app session) gets its own read-only connection,
+        # so concurrent reads do not wait on each other. Only the thread holds it, so it is
+        # closed when the thread exits (streamlit runs every script rerun in a new thread)
+        self._read_uri = f"file:{db_path}?mode=ro"
+        self._local = threading.local()
+        self._read_conns: weakref.WeakSet[_ThreadConnection] = weakref.WeakSet()
+        self._read_conns_lock = threading.Lock()
+        if not read_mode:
+            synchronous, journal_mode = synchronous.upper(), journal_mode.upper()
+            if synchronous not in SYNCHRONOUS_MODES or journal_mode not in JOURNAL_MODES:
+                raise ValueError(f"invalid pragmas {synchronous}, {journal_mode}")
+            self._write_conn = sqlite3.connect(db_path)
+            # NOTE with WAL, readers (e.g. the app) keep reading while images are inserted, and
+            # synchronous NORMAL only syncs at checkpoints while staying corruption-safe
+            self._write_conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+            self._write_conn.execute(f"PRAGMA synchronous = {synchronous}")
         self.conn.execute(
             """
             CREATE TABLE IF NOT EXISTS images (
-                id TEXT PRIMARY KEY, extension TEXT, timestamp TEXT, bytes BLOB, small_bytes BLOB
+                id TEXT PRIMARY KEY, extension TEXT, timestamp TEXT, bytes BLOB, small_bytes BLOB,
+                path TEXT, small_path TEXT
             )
             """
         )
+        # NOTE bytes and small_bytes are NULL for images stored as files, path and small_path
+        # being relative to the blob store, or absolute for originals referenced in place
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(images)")}
+        if not read_mode:
+            for column in ("path", "small_path"):
+                if column not in columns:
+                    self.conn.execute(f"ALTER TABLE images ADD COLUMN {column} TEXT")
+        # NOTE databases created before the blob store can still be opened in read mode
+        self._has_paths = not read_mode or "path" in columns
         # NOTE separate table for performance reasons
         self.conn.execute(
             """
@@ -38,6 +196,28 @@ class StorageDB:
             )
             """
         )
+        # NOTE written by scripts/find_duplicates.py, images of a cluster share its number
+        if not read_mode:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS duplicates (
+                    id TEXT PRIMARY KEY, cluster INTEGER, FOREIGN KEY (id) REFERENCES images (id)
+                )
+                """
+            )
+            # NOTE counter bumped by triggers on every write to the indexed tables, for the
+            # watermark: row counts and rowids miss replaced rows and reused rowids
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS changes (id INTEGER PRIMARY KEY, counter INTEGER)"
+            )
+            self.conn.execute("INSERT OR IGNORE INTO changes (id, counter) VALUES (0, 0)")
+            for table in ("images", "tags", "features"):
+                for event in ("INSERT", "UPDATE", "DELETE"):
+                    self.conn.execute(
+                        f"CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_changes "
+                        f"AFTER {event} ON {table} "
+                        "BEGIN UPDATE changes SET counter = counter + 1 WHERE id = 0; END"
+                    )
         self.conn.commit()
 
     def insert_image(
@@ -46,14 +226,9 @@ class StorageDB:
         small_img_bytes: bytes,
         extension: str,
         timestamp: Optional[datetime] = None,
+        path: Optional[str] = None,
     ) -> str:
-        img_id = sha1(img_bytes).hexdigest()
-        timestamp = timestamp.isoformat() if timestamp is not None else None
-        self.conn.execute(
-            "INSERT OR IGNORE INTO images (id, extension, timestamp, bytes, small_bytes) VALUES (?, ?, ?, ?, ?)",
-            (img_id, extension, timestamp, img_bytes, small_img_bytes),
-        )
-        return img_id
+        return self.insert_images([(img_bytes, small_img_bytes, extension, timestamp)], [path])[0]
 
     def insert_tags(self, img_id: str, tags: set[str]):
         tags_json = json.dumps(list(tags))
@@ -69,29 +244,361 @@ class StorageDB:
             (img_id, feature_bytes, feature_bytes),
         )
 
-    def create_index(self) -> CompositeIndex:
+    def insert_images(
+        self,
+        images: list[tuple[bytes, bytes, str, Optional[datetime]]],
+        paths: Optional[list[Optional[str]]] = None,
+    ) -> list[str]:
+        """
+        Insert (img_bytes, small_img_bytes, extension, timestamp) tuples with one executemany.
+        When paths[i] is given, the i-th original is referenced at that path instead of being
+        copied, so the file must not be moved afterwards. Like the other insert_* methods,
+        nothing is committed: all the inserts until commit form one transaction.
+        """
+        img_ids = [sha1(img_bytes).hexdigest() for img_bytes, _, _, _ in images]
+        if self.pack_thumbnails:
+            self.thumbnail_pack.add(
+                (img_id, small_img_bytes, extension)
+                for img_id, (_, small_img_bytes, extension, _) in zip(img_ids, images)
+            )
+        rows = []
+        for img_id, (img_bytes, small_img_bytes, extension, timestamp), path in zip(
+            img_ids, images, paths or [None] * len(images)
+        ):
+            small_path = None
+            if path is not None:
+                img_bytes, path = None, os.path.abspath(path)
+            elif self.store_blobs:
+                img_bytes, path = None, self.blob_store.put(img_id, img_bytes, extension)
+            if self.store_blobs:
+                small_path = self.blob_store.put(img_id, small_img_bytes, f".small{extension}")
+                small_img_bytes = None
+            # NOTE an image deleted and inserted again before commit keeps its files
+            self._deleted_paths.difference_update((path, small_path))
+            # NOTE stored as naive UTC, which numpy parses without warnings (see decode_timestamps)
+            timestamp = None if timestamp is None else to_naive_utc(timestamp).isoformat()
+            rows.append(
+                (img_id, extension, timestamp, img_bytes, small_img_bytes, path, small_path)
+            )
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO images "
+            "(id, extension, timestamp, bytes, small_bytes, path, small_path) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        return img_ids
+
+    def insert_tags_many(self, img_ids: list[str], tags: list[set[str]]) -> None:
+        self.conn.executemany(
+            "INSERT INTO tags (id, tags) VALUES (?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET tags = excluded.tags",
+            ((img_id, json.dumps(list(img_tags))) for img_id, img_tags in zip(img_ids, tags)),
+        )
+
+    def insert_features_many(self, img_ids: list[str], features: np.ndarray) -> None:
+        self.conn.executemany(
+            "INSERT INTO features (id, features) VALUES (?, ?) "
+            "ON CONFLICT DO UPDATE SET features = excluded.features",
+            ((img_id, feat.tobytes()) for img_id, feat in zip(img_ids, features)),
+        )
+
+    def create_index(
+        self, load_features: bool = True, n_workers: Optional[int] = None, batch_size: int = 8192
+    ) -> CompositeIndex:
+        """
+        Build the in-memory index. With load_features=False the CLIP features are left in the
+        database (e.g. when a compressed engine is used instead) and index.features is None.
+
+        The feature matrix is allocated once and filled batch by batch, while the tags are
+        decoded by n_workers processes (default: one per ROWS_PER_WORKER rows, at most one
+        per core), each over a range of rowids.
+        """
+        n_rows, max_rowid = self.conn.execute(
+            f"SELECT COUNT(*), MAX(tags.rowid) {INDEX_JOIN}"
+        ).fetchone()
+        if n_workers is None:
+            n_workers = min(os.cpu_count() or 1, n_rows // ROWS_PER_WORKER)
+        bounds = np.linspace(0, (max_rowid or 0) + 1, max(n_workers, 1) + 1).astype(int).tolist()
+        executor = None
+        if n_workers > 1:
+            # NOTE workers open their own connection, so they only see committed rows
+            executor = ProcessPoolExecutor(n_workers, multiprocessing.get_context("spawn"))
+            chunks = [
+                executor.submit(_decode_tag_rows_worker, self.db_path, lo, hi)
+                for lo, hi in zip(bounds[:-1], bounds[1:])
+            ]
+
+        features = None
+        if load_features:
+            # NOTE filled while the workers decode the tags
+            cur = self.conn.execute(
+                f"SELECT features {INDEX_JOIN} WHERE tags.rowid < ? {INDEX_ORDER}", (bounds[-1],)
+            )
+            row = 0
+            while blobs := cur.fetchmany(batch_size):
+                batch = np.frombuffer(b"".join(blob for (blob,) in blobs), dtype=np.float32)
+                if features is None:
+                    features = np.empty((n_rows, len(batch) // len(blobs)), dtype=np.float32)
+                features[row : row + len(blobs)] = batch.reshape(len(blobs), -1)
+                row += len(blobs)
+            if features is None:
+                features = np.empty((0, 0), dtype=np.float32)
+
+        if executor is None:
+            chunks = [decode_tag_rows(self.conn, bounds[0], bounds[-1])]
+        else:
+            chunks = [chunk.result() for chunk in chunks]
+            executor.shutdown()
+
+        # NOTE chunks are in row order, so merging their vocabularies keeps the order of first
+        # appearance
+        img_ids: list[str] = []
+        tag_vocab: dict[str, int] = {}
+        tag_ids, tag_offsets, timestamps = [], [np.zeros(1, dtype=np.int64)], []
+        for chunk_ids, chunk_vocab, chunk_tag_ids, chunk_offsets, chunk_timestamps in chunks:
+            to_global = [tag_vocab.setdefault(tag, len(tag_vocab)) for tag in chunk_vocab]
+            tag_ids.append(np.array(to_global, dtype=TAG_ID_DTYPE)[chunk_tag_ids])
+            tag_offsets.append(tag_offsets[-1][-1] + chunk_offsets[1:])
+            img_ids.extend(chunk_ids)
+            timestamps.append(chunk_timestamps)
+        if len(img_ids) != n_rows or (features is not None and len(features) != n_rows):
+            raise RuntimeError("the database changed while the index was being built")
+        return CompositeIndex(
+            img_ids,
+            tag_vocab,
+            np.concatenate(tag_ids),
+            np.concatenate(tag_offsets),
+            features,
+            timestamps=np.concatenate(timestamps),
+        )
+
+    def watermark(self) -> dict:
+        """
+        Change counter and row counts of the indexed tables, to detect a stale index snapshot.
+        The counter is None for databases not opened for writing since it was introduced.
+        """
+        watermark = {}
+        for table in ("tags", "features"):
+            cur = self.conn.execute(f"SELECT COUNT(*), MAX(rowid) FROM {table}")
+            watermark[table] = list(cur.fetchone())
+        cur = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'changes'"
+        )
+        if cur.fetchone() is None:
+            watermark["changes"] = None
+        else:
+            watermark["changes"] = self.conn.execute("SELECT counter FROM changes").fetchone()[0]
+        return watermark
+
+    def load_index(self, snapshot_dir: str) -> CompositeIndex:
+        """
+        Memory-map the index snapshot in snapshot_dir if it is up to date with the database,
+        otherwise build the index and save a new snapshot.
+        """
+        watermark = self.watermark()
+        index = CompositeIndex.load(snapshot_dir, watermark)
+        if index is None:
+            index = self.create_index()
+            index.save(snapshot_dir, watermark)
+        return index
+
+    def iter_features(self, batch_size: int = 65536) -> Iterator[tuple[list[str], np.ndarray]]:
+        """Yield (img_ids, features) batches in the same row order as create_index."""
+        cur = self.conn.execute(
+            "SELECT tags.id, features FROM tags JOIN features ON tags.id = features.id "
+            + INDEX_ORDER
+        )
+        while rows := cur.fetchmany(batch_size):
+            img_ids, blobs = zip(*rows)
+            yield list(img_ids), np.frombuffer(b"".join(blobs), dtype=np.float32).reshape(
+                len(blobs), -1
+            )
+
+    def iter_rows(
+        self, batch_size: int = 65536
+    ) -> Iterator[tuple[list[str], np.ndarray, list[set[str]], np.ndarray]]:
+        """
+        Yield (img_ids, features, tags, timestamps) batches in the same row order as
+        create_index, timestamps being epoch seconds as in the index.
+        """
+        cur = self.conn.execute(
+            "SELECT tags.id, features, tags, timestamp FROM tags "
+            "JOIN features ON tags.id = features.id LEFT JOIN images ON tags.id = images.id "
+            + INDEX_ORDER
+        )
+        while rows := cur.fetchmany(batch_size):
+            img_ids, blobs, tags, timestamps = zip(*rows)
+            features = np.frombuffer(b"".join(blobs), dtype=np.float32).reshape(len(blobs), -1)
+            tags = [set(json.loads(t)) for t in tags]
+            yield list(img_ids), features, tags, decode_timestamps(timestamps)
+
+    def sample_features(self, n: int) -> np.ndarray:
+        cur = self.conn.execute("SELECT features FROM features ORDER BY RANDOM() LIMIT ?", (n,))
+        return np.stack([np.frombuffer(blob, dtype=np.float32) for (blob,) in cur])
+
+    def retrieve_features(self, img_ids: list[str], missing_ok: bool = False) -> np.ndarray:
+        """
+        Features of the given images, in the same order. Missing images get zero rows if
+        missing_ok, e.g. when they were deleted but are still tombstoned in an index.
+        """
+        blobs = {}
+        # NOTE stay below SQLite's limit of host parameters per statement
+        for start in range(0, len(img_ids), 900):
+            batch = img_ids[start : start + 900]
+            cur = self.conn.execute(
+                f"SELECT id, features FROM features WHERE id IN ({','.join('?' * len(batch))})",
+                batch,
+            )
+            blobs.update(cur)
+        if not missing_ok and len(blobs) < len(set(img_ids)):
+            raise KeyError("features not found for some images")
+        dim = next((len(blob) // 4 for blob in blobs.values()), 0)
+        features = np.zeros((len(img_ids), dim), dtype=np.float32)
+        for i, img_id in enumerate(img_ids):
+            if img_id in blobs:
+                features[i] = np.frombuffer(blobs[img_id], dtype=np.float32)
+        return features
+
+    def features_fetcher(self, index: CompositeIndex) -> Callable[[np.ndarray], np.ndarray]:
+        """Callable loading the features of index rows lazily, for exact re-ranking."""
+
+        def fetch_features(rows: np.ndarray) -> np.ndarray:
+            img_ids = [index.img_ids[i] for i in rows]
+            return self.retrieve_features(img_ids, missing_ok=bool(index.n_deleted))
+
+        return fetch_features
+
+    def save_duplicates(self, clusters: list[list[str]]) -> None:
+        """Replace the stored near-duplicate clusters."""
+        self.conn.execute("DELETE FROM duplicates")
+        self.conn.executemany(
+            "INSERT INTO duplicates (id, cluster) VALUES (?, ?)",
+            ((img_id, i) for i, cluster in enumerate(clusters) for img_id in cluster),
+        )
+
+    def retrieve_duplicates(self) -> list[list[str]]:
+        cur = self.conn.execute("SELECT id, cluster FROM duplicates ORDER BY cluster, rowid")
+        clusters: dict[int, list[str]] = {}
+        for img_id, cluster in cur:
+            clusters.setdefault(cluster, []).append(img_id)
+        return list(clusters.values())
+
+    def delete_images(self, img_ids: list[str]) -> None:
+        """Delete images; their files in the blob store are removed by the next commit."""
+        paths = []
+        if self._has_paths:
+            for img_id in img_ids:
+                cur = self.conn.execute(
+                    "SELECT path, small_path FROM images WHERE id = ?", (img_id,)
+                )
+                paths.extend(cur.fetchone() or ())
+        for table in ("duplicates", "tags", "features", "images"):
+            self.conn.executemany(f"DELETE FROM {table} WHERE id = ?", ((i,) for i in img_ids))
+        self._deleted_paths.update(path for path in paths if path is not None)
+
+    def _retrieve_blob(
+        self, img_id: str, bytes_column: str, path_column: str
+    ) -> Optional[tuple[str, Optional[bytes], Optional[str]]]:
+        path_column = path_column if self._has_paths else "NULL"
         cur = self.conn.execute(
-            "SELECT tags.id, tags, features FROM tags JOIN features ON tags.id = features.id"
+            f"SELECT extension, {bytes_column}, {path_column} FROM images WHERE id = ?", (img_id,)
         )
-        img_ids, img_tags, features = [], [], []
-        for img_id, tags, blob in cur:
-            img_ids.append(img_id)
-            img_tags.append(set(json.loads(tags)))
-            features.append(np.frombuffer(blob, dtype=np.float32))
-        features = np.stack(features)
-        return CompositeIndex(img_ids, img_tags, features)
-
-    def retrieve_small_img(self, img_id: str) -> Optional[tuple[str, bytes]]:
-        cur = self.conn.execute("SELECT extension, small_bytes FROM images WHERE id = ?", (img_id,))
         return cur.fetchone()
 
+    def retrieve_small_img(self, img_id: str) -> Optional[tuple[str, Union[bytes, memoryview]]]:
+        if self.thumbnail_pack is not None:
+            packed = self.thumbnail_pack.get(img_id)
+            if packed is not None:
+                return packed
+        row = self._retrieve_blob(img_id, "small_bytes", "small_path")
+        if row is None:
+            return None
+        extension, small_bytes, small_path = row
+        if small_bytes is None:
+            small_bytes = self.blob_store.get(small_path)
+        return extension, small_bytes
+
     def retrieve_img(self, img_id: str) -> Optional[tuple[str, bytes]]:
-        cur = self.conn.execute("SELECT extension, bytes FROM images WHERE id = ?", (img_id,))
-        return cur.fetchone()
+        row = self._retrieve_blob(img_id, "bytes", "path")
+        if row is None:
+            return None
+        extension, img_bytes, path = row
+        if img_bytes is None:
+            img_bytes = self.blob_store.get(path)
+        return extension, img_bytes
+
+    def retrieve_img_path(self, img_id: str, small: bool = False) -> Optional[tuple[str, str]]:
+        """
+        (extension, absolute file path) of an image or its thumbnail stored as a file, to serve
+        it without reading it in Python (e.g. with sendfile). None if it is not stored as a file.
+        """
+        row = self._retrieve_blob(img_id, "NULL", "small_path" if small else "path")
+        if row is None or row[2] is None:
+            return None
+        return row[0], self.blob_store.resolve(row[2])
+
+    def backfill_thumbnail_pack(self, batch_size: int = 900) -> None:
+        """
+        Append the thumbnails of images inserted without pack_thumbnails to the pack. Only the
+        ids are scanned, the thumbnails are read for the images missing from the pack.
+        """
+        if not self.pack_thumbnails:
+            raise ValueError("the database was not opened with pack_thumbnails")
+        small_path = "small_path" if self._has_paths else "NULL"
+        cur = self.conn.execute("SELECT id FROM images ORDER BY rowid")
+        while rows := cur.fetchmany(batch_size):
+            missing = [img_id for (img_id,) in rows if img_id not in self.thumbnail_pack]
+            if not missing:
+                continue
+            # NOTE batch_size stays below SQLite's limit of host parameters per statement
+            blobs = self.conn.execute(
+                f"SELECT id, small_bytes, {small_path}, extension FROM images "
+                f"WHERE id IN ({','.join('?' * len(missing))}) ORDER BY rowid",
+                missing,
+            )
+            self.thumbnail_pack.add(
+                (img_id, self.blob_store.get(path) if blob is None else blob, extension)
+                for img_id, blob, path, extension in blobs
+            )
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """The write connection, or in read mode the calling thread's read-only connection."""
+        if not self.read_mode:
+            return self._write_conn
+        thread_conn = getattr(self._local, "conn", None)
+        if thread_conn is None:
+            # NOTE not checking the thread, so that close can close every connection
+            conn = sqlite3.connect(self._read_uri, uri=True, check_same_thread=False)
+            conn.execute(f"PRAGMA mmap_size = {READ_MMAP_SIZE}")
+            conn.execute(f"PRAGMA cache_size = -{READ_CACHE_KIB}")
+            thread_conn = _ThreadConnection(conn)
+            with self._read_conns_lock:
+                self._read_conns.add(thread_conn)
+            self._local.conn = thread_conn
+        return thread_conn.conn
 
     def close(self):
-        self.commit()
-        self.conn.close()
+        if not self.read_mode:
+            self.commit()
+            self._write_conn.close()
+        if self.thumbnail_pack is not None:
+            self.thumbnail_pack.close()
+        with self._read_conns_lock:
+            for thread_conn in list(self._read_conns):
+                thread_conn.conn.close()
+            self._read_conns.clear()
+        self._local = threading.local()
 
     def commit(self):
-        self.conn.commit()
+        if not self.read_mode:
+            self._write_conn.commit()
+            for path in self._deleted_paths:
+                self.blob_store.delete(path)
+            self._deleted_paths.clear()
+
+    def rollback(self):
+        """Discard the changes since the last commit, keeping the files of deleted images."""
+        if not self.read_mode:
+            self._write_conn.rollback()
+            self._deleted_paths.clear()
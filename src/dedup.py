@@ -0,0 +1,108 @@
+"""
+Near-duplicate detection: a blocked self-join of the CLIP features, where every pair of row
+tiles is scored with one GEMM and only the pairs above a threshold are kept.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
+
+import numpy as np
+
+
+class UnionFind:
+    """Disjoint sets over rows 0..n-1, with path halving and union by size."""
+
+    def __init__(self, n: int):
+        self.parent = np.arange(n)
+        self.size = np.ones(n, dtype=np.int64)
+
+    def find(self, i: int) -> int:
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i: int, j: int) -> None:
+        i, j = self.find(i), self.find(j)
+        if i == j:
+            return
+        if self.size[i] < self.size[j]:
+            i, j = j, i
+        self.parent[j] = i
+        self.size[i] += self.size[j]
+
+    def labels(self) -> np.ndarray:
+        """Root of every row, by pointer jumping over the whole parent array."""
+        labels = self.parent
+        while not np.array_equal(grandparents := labels[labels], labels):
+            labels = grandparents
+        return labels
+
+
+def _tile_pairs(
+    features: np.ndarray, start_i: int, start_j: int, tile_size: int, threshold: float
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    tile_i = np.asarray(features[start_i : start_i + tile_size], dtype=np.float32)
+    tile_j = np.asarray(features[start_j : start_j + tile_size], dtype=np.float32)
+    sim = tile_i @ tile_j.T
+    hits = sim >= threshold
+    if start_i == start_j:
+        # NOTE on diagonal tiles, only keep every pair once and skip self-pairs
+        hits = np.triu(hits, 1)
+    rows_i, rows_j = np.nonzero(hits)
+    return rows_i + start_i, rows_j + start_j, sim[rows_i, rows_j]
+
+
+def iter_similar_pairs(
+    features: np.ndarray,
+    threshold: float = 0.95,
+    tile_size: int = 4096,
+    n_workers: Optional[int] = None,
+) -> Iterator[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Yield (rows_i, rows_j, similarities) with rows_i < rows_j for every pair of features whose
+    inner product reaches threshold. Memory is bounded by a few tile_size x tile_size score
+    matrices, and features can be memory-mapped. Tiles are scored in n_workers threads (numpy
+    releases the GIL during the GEMM).
+    """
+    # NOTE generated lazily, the number of tiles is quadratic in the number of rows
+    tiles = (
+        (start_i, start_j)
+        for start_i in range(0, len(features), tile_size)
+        for start_j in range(start_i, len(features), tile_size)
+    )
+    n_workers = n_workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(n_workers) as executor:
+        # NOTE submit a bounded window of tiles, so finished results do not pile up
+        pending = []
+        for start_i, start_j in tiles:
+            pending.append(
+                executor.submit(_tile_pairs, features, start_i, start_j, tile_size, threshold)
+            )
+            if len(pending) >= 2 * n_workers:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+def find_duplicates(
+    features: np.ndarray,
+    threshold: float = 0.95,
+    tile_size: int = 4096,
+    n_workers: Optional[int] = None,
+) -> list[np.ndarray]:
+    """
+    Group rows into clusters of near-duplicates: rows are linked when their similarity reaches
+    threshold, and clusters are the connected components (so similarity is transitive).
+    Returns the sorted rows of every cluster with at least two rows.
+    """
+    union_find = UnionFind(len(features))
+    for rows_i, rows_j, _ in iter_similar_pairs(features, threshold, tile_size, n_workers):
+        for i, j in zip(rows_i.tolist(), rows_j.tolist()):
+            union_find.union(i, j)
+    labels = union_find.labels()
+    order = np.argsort(labels, kind="stable")
+    splits = np.flatnonzero(np.diff(labels[order])) + 1
+    return [cluster for cluster in np.split(order, splits) if len(cluster) > 1]
@@ -0,0 +1,227 @@
+"""
+Hierarchical Navigable Small World (HNSW) graph index for CLIP features.
+"""
+
+import heapq
+import math
+import os
+from hashlib import sha1
+from typing import Optional
+
+import numpy as np
+
+from src.index import select_top_k
+
+
+def ids_digest(img_ids: list[str]) -> str:
+    """Fingerprint of the row order, to check a saved graph still matches the index."""
+    digest = sha1()
+    for img_id in img_ids:
+        digest.update(img_id.encode())
+    return digest.hexdigest()
+
+
+class HNSWIndex:
+    """
+    Graph over the rows of features, searched by inner product. Node ids are row numbers, so
+    the graph can only be used with the feature matrix (and row order) it was built on.
+    """
+
+    def __init__(
+        self,
+        features: np.ndarray,
+        M: int = 16,
+        ef_construction: int = 100,
+        ef_search: int = 64,
+        seed: int = 0,
+    ):
+        self.features = features
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.level_mult = 1 / math.log(M)
+        self.rng = np.random.default_rng(seed)
+        # NOTE neighbors[node][level] is the adjacency list of node at that level
+        self.neighbors: list[list[list[int]]] = []
+        self.entry_point: Optional[int] = None
+        self.max_level = -1
+
+    def __len__(self) -> int:
+        return len(self.neighbors)
+
+    def add(
+        self, features: Optional[np.ndarray] = None, index_features: Optional[np.ndarray] = None
+    ) -> None:
+        """
+        Insert the rows of the feature matrix that are not in the graph yet. index_features, if
+        given, replaces the matrix and must start with the rows already in the graph; the new
+        rows (features) are read from it.
+        """
+        if index_features is not None:
+            self.features = index_features
+        for node in range(len(self.neighbors), len(self.features)):
+            self._insert(node)
+
+    def compact(self, keep: np.ndarray, index_features: Optional[np.ndarray]) -> "HNSWIndex":
+        """Graphs do not support deletion, so the compacted rows are inserted in a new graph."""
+        index = HNSWIndex(index_features, self.M, self.ef_construction, self.ef_search)
+        index.add()
+        return index
+
+    def search(
+        self, query_feat: np.ndarray, top_k: int, ef_search: Optional[int] = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        if self.entry_point is None:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        query_feat = query_feat.reshape(-1)
+        entry = self._greedy_descent(query_feat, self.entry_point, self.max_level, 0)
+        ef = max(ef_search or self.ef_search, top_k)
+        results = self._search_layer(query_feat, [entry], ef, 0)[:top_k]
+        rows = np.array([node for _, node in results], dtype=np.int64)
+        scores = np.array([sim for sim, _ in results], dtype=np.float32)
+        return rows, scores
+
+    def _insert(self, node: int) -> None:
+        level = int(-math.log(1.0 - self.rng.random()) * self.level_mult)
+        self.neighbors.append([[] for _ in range(level + 1)])
+        if self.entry_point is None:
+            self.entry_point, self.max_level = node, level
+            return
+
+        query_feat = self.features[node]
+        entry = self._greedy_descent(query_feat, self.entry_point, self.max_level, level + 1)
+        entry_points = [entry]
+        for lc in range(min(level, self.max_level), -1, -1):
+            candidates = self._search_layer(query_feat, entry_points, self.ef_construction, lc)
+            selected = self._select_neighbors(candidates, self.M)
+            self.neighbors[node][lc] = selected
+            max_neighbors = 2 * self.M if lc == 0 else self.M
+            for neighbor in selected:
+                neighbor_list = self.neighbors[neighbor][lc]
+                neighbor_list.append(node)
+                if len(neighbor_list) > max_neighbors:
+                    sims = self.features[neighbor_list] @ self.features[neighbor]
+                    keep = select_top_k(sims, max_neighbors)
+                    self.neighbors[neighbor][lc] = [neighbor_list[i] for i in keep]
+            entry_points = [n for _, n in candidates]
+
+        if level > self.max_level:
+            self.entry_point, self.max_level = node, level
+
+    def _greedy_descent(
+        self, query_feat: np.ndarray, entry: int, from_level: int, to_level: int
+    ) -> int:
+        """Walk down from from_level to to_level, keeping only the closest node on each level."""
+        best_sim = float(self.features[entry] @ query_feat)
+        for level in range(from_level, to_level - 1, -1):
+            improved = True
+            while improved:
+                improved = False
+                neighbors = self.neighbors[entry][level]
+                if not neighbors:
+                    break
+                sims = self.features[neighbors] @ query_feat
+                i = int(np.argmax(sims))
+                if sims[i] > best_sim:
+                    best_sim, entry, improved = float(sims[i]), neighbors[i], True
+        return entry
+
+    def _search_layer(
+        self, query_feat: np.ndarray, entry_points: list[int], ef: int, level: int
+    ) -> list[tuple[float, int]]:
+        """Best-first search on one level. Returns (similarity, node) pairs, best first."""
+        visited = set(entry_points)
+        sims = (self.features[entry_points] @ query_feat).tolist()
+        candidates = [(-sim, node) for sim, node in zip(sims, entry_points)]
+        results = [(sim, node) for sim, node in zip(sims, entry_points)]
+        heapq.heapify(candidates)
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            neg_sim, node = heapq.heappop(candidates)
+            if -neg_sim < results[0][0] and len(results) >= ef:
+                break
+            neighbors = [n for n in self.neighbors[node][level] if n not in visited]
+            if not neighbors:
+                continue
+            visited.update(neighbors)
+            sims = (self.features[neighbors] @ query_feat).tolist()
+            for sim, neighbor in zip(sims, neighbors):
+                if len(results) < ef or sim > results[0][0]:
+                    heapq.heappush(candidates, (-sim, neighbor))
+                    heapq.heappush(results, (sim, neighbor))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return sorted(results, reverse=True)
+
+    def _select_neighbors(self, candidates: list[tuple[float, int]], M: int) -> list[int]:
+        """
+        Neighbor selection heuristic: keep a candidate only if it is closer to the new node than
+        to every neighbor already selected, so links point in diverse directions.
+        """
+        selected: list[int] = []
+        for sim, node in candidates:
+            if not selected or np.all(self.features[selected] @ self.features[node] < sim):
+                selected.append(node)
+                if len(selected) == M:
+                    break
+        return selected
+
+    def save(self, path: str, img_ids: list[str]) -> None:
+        levels = np.array([len(node_neighbors) - 1 for node_neighbors in self.neighbors])
+        arrays = {}
+        for level in range(self.max_level + 1):
+            adjacency = [
+                node_neighbors[level]
+                for node_neighbors in self.neighbors
+                if len(node_neighbors) > level
+            ]
+            arrays[f"counts_{level}"] = np.array([len(a) for a in adjacency], dtype=np.int32)
+            arrays[f"neighbors_{level}"] = np.array(
+                [n for a in adjacency for n in a], dtype=np.int32
+            )
+        # NOTE write through a file object so numpy does not append a .npz suffix to path
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                levels=levels.astype(np.int8),
+                entry_point=-1 if self.entry_point is None else self.entry_point,
+                params=np.array([self.M, self.ef_construction, self.ef_search]),
+                ids_digest=ids_digest(img_ids),
+                **arrays,
+            )
+
+    @classmethod
+    def load(cls, path: str, features: np.ndarray, img_ids: list[str]) -> Optional["HNSWIndex"]:
+        """Load a saved graph, or None if it was built for other images or another row order."""
+        with np.load(path) as data:
+            if str(data["ids_digest"]) != ids_digest(img_ids):
+                return None
+            M, ef_construction, ef_search = (int(x) for x in data["params"])
+            index = cls(features, M, ef_construction, ef_search)
+            levels = data["levels"]
+            index.neighbors = [[] for _ in range(len(levels))]
+            for level in range(int(levels.max(initial=-1)) + 1):
+                nodes = np.flatnonzero(levels >= level)
+                flat = data[f"neighbors_{level}"].tolist()
+                offsets = np.concatenate([[0], np.cumsum(data[f"counts_{level}"])]).tolist()
+                for i, node in enumerate(nodes.tolist()):
+                    index.neighbors[node].append(flat[offsets[i] : offsets[i + 1]])
+            entry_point = int(data["entry_point"])
+        index.entry_point = None if entry_point < 0 else entry_point
+        index.max_level = int(levels.max(initial=-1))
+        return index
+
+    @classmethod
+    def load_or_build(
+        cls, path: str, features: np.ndarray, img_ids: list[str], **params
+    ) -> "HNSWIndex":
+        """Load the graph saved at path, (re)building and saving it if missing or stale."""
+        index = cls.load(path, features, img_ids) if os.path.exists(path) else None
+        if index is None:
+            index = cls(features, **params)
+            index.add()
+            index.save(path, img_ids)
+        return index
@@ -1,14 +1,139 @@
-from typing import Iterable
+import copy
+import json
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable, Iterable, Iterator, Optional, Protocol, Sequence, Union
 
 import numpy as np
 
+from src.bitmap import Bitmap, evaluate_tag_query, parse_tag_query
 
-def argsort(seq, ascending: bool = True):
-    # http://stackoverflow.com/questions/3071415/efficient-method-to-calculate-the-rank-vector-of-a-list-in-python
-    sorted_seq = sorted(range(len(seq)), key=seq.__getitem__)
-    if ascending:
-        return sorted_seq
-    return list(reversed(sorted_seq))
+# NOTE approximate engines only score a subset of images, so combined queries re-rank a larger
+# pool of CLIP candidates with their tag overlap
+COMBINED_CANDIDATES_FACTOR = 10
+
+SNAPSHOT_VERSION = 3
+# NOTE snapshot versions replaced for longer than this are removed by the next save
+SNAPSHOT_GRACE_SECONDS = 60
+# NOTE tag ids are stored as uint16, enough for the RAM vocabulary (4585 tags)
+TAG_ID_DTYPE = np.uint16
+# NOTE images without a timestamp get NaT, which is the smallest int64
+NO_TIMESTAMP = np.iinfo(np.int64).min
+
+# NOTE [start, end) with either bound optional
+TimeRange = tuple[Optional[datetime], Optional[datetime]]
+# NOTE image counts per tag (most frequent first) and per month ("2021-06", chronologically)
+Facets = tuple[dict[str, int], dict[str, int]]
+
+# NOTE number of bits set in each byte value, used when np.bitwise_count is not available
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class ClipEngine(Protocol):
+    def search(self, query_feat: np.ndarray, top_k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Return the rows and CLIP similarities of the (approximate) top_k images."""
+
+    def add(self, features: np.ndarray, index_features: Optional[np.ndarray]) -> None:
+        """
+        Index the rows just appended to the index. features are the new rows and
+        index_features the updated feature matrix of the index (None if it does not keep one).
+        """
+
+    def compact(self, keep: np.ndarray, index_features: Optional[np.ndarray]) -> "ClipEngine":
+        """Return an engine over the rows where keep is True, renumbered from 0."""
+
+
+class GrowableRows:
+    """
+    Rows of an array with amortized O(1) appends, by over-allocating capacity. Read-only
+    (e.g. memory-mapped) arrays are copied on the first append.
+    """
+
+    def __init__(self, data: np.ndarray):
+        self.buffer = data
+        self.n_rows = len(data)
+
+    @property
+    def array(self) -> np.ndarray:
+        return self.buffer[: self.n_rows]
+
+    def append(self, rows: np.ndarray) -> None:
+        needed = self.n_rows + len(rows)
+        if needed > len(self.buffer) or not self.buffer.flags.writeable:
+            capacity = max(needed, int(len(self.buffer) * 1.5), 1024)
+            buffer = np.empty((capacity, *self.buffer.shape[1:]), dtype=self.buffer.dtype)
+            buffer[: self.n_rows] = self.buffer[: self.n_rows]
+            self.buffer = buffer
+        self.buffer[self.n_rows : needed] = rows
+        self.n_rows = needed
+
+
+def select_top_k(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """
+    Return the indices of the top_k highest scores, best first.
+
+    Uses a partial partition so only the selected k items are sorted. Ties are broken by the
+    lowest index, so results are deterministic.
+    """
+    n = len(scores)
+    if top_k <= 0 or n == 0:
+        return np.empty(0, dtype=np.int64)
+    if top_k < n:
+        kth = np.partition(scores, n - top_k)[n - top_k]
+        above = np.flatnonzero(scores > kth)
+        ties = np.flatnonzero(scores == kth)[: top_k - len(above)]
+        idx = np.concatenate([above, ties])
+    else:
+        idx = np.arange(n)
+    return idx[np.lexsort((idx, -scores[idx]))]
+
+
+def select_top_k_counts(counts: np.ndarray, top_k: int) -> np.ndarray:
+    """
+    Same as select_top_k, for small non-negative integer scores (e.g. tag overlap counts).
+
+    Counts take few distinct values, so the k-th value is found by bucketing them in O(n).
+    """
+    if top_k <= 0 or len(counts) == 0:
+        return np.empty(0, dtype=np.int64)
+    hist = np.bincount(counts)
+    # NOTE number of items with a count >= each bucket, from the highest bucket down
+    n_at_least = np.cumsum(hist[::-1])[::-1]
+    kth = np.flatnonzero(n_at_least >= top_k)
+    kth = kth[-1] if len(kth) else 0
+    above = np.flatnonzero(counts > kth)
+    above = above[np.argsort(-counts[above], kind="stable")]
+    ties = np.flatnonzero(counts == kth)[: top_k - len(above)]
+    return np.concatenate([above, ties])
+
+
+def merge_top_k(
+    rows: np.ndarray, scores: np.ndarray, new_rows: np.ndarray, new_scores: np.ndarray, top_k: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Merge two (Q, *) matrices of per-query candidates into the (Q, top_k) best ones, best
+    first, ties broken by the lowest row.
+    """
+    rows = np.concatenate([rows, new_rows], axis=1)
+    scores = np.concatenate([scores, new_scores], axis=1)
+    if scores.shape[1] > top_k:
+        # NOTE as in select_top_k: keep the scores above the k-th one, then the lowest rows among
+        # those tied with it
+        kth = -np.partition(-scores, top_k - 1, axis=1)[:, top_k - 1, None]
+        above = scores > kth
+        ties = scores == kth
+        keep = above | ties
+        n_ties = top_k - above.sum(axis=1)
+        for q in np.flatnonzero(keep.sum(axis=1) > top_k):
+            tied = np.flatnonzero(ties[q])
+            keep[q, tied[np.argsort(rows[q, tied], kind="stable")[n_ties[q] :]]] = False
+        rows = rows[keep].reshape(len(rows), top_k)
+        scores = scores[keep].reshape(len(scores), top_k)
+    order = np.lexsort((rows, -scores), axis=1)
+    return np.take_along_axis(rows, order, axis=1), np.take_along_axis(scores, order, axis=1)
 
 
 def cos_sim(a, b):
@@ -17,36 +142,992 @@ def cos_sim(a, b):
     return a @ b.T
 
 
-class CompositeIndex:
-    def __init__(self, img_ids: list[str], tags: list[set[str]], features: np.ndarray):
-        self.img_ids = img_ids
-        self.tags = tags
+def popcount_rows(bits: np.ndarray) -> np.ndarray:
+    """Number of bits set in each row of an unsigned integer matrix."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(bits).sum(axis=1, dtype=np.int32)
+    return POPCOUNT[bits.view(np.uint8)].sum(axis=1, dtype=np.int32)
+
+
+class BinaryEngine:
+    """
+    CLIP engine over sign bits: each feature is stored as one bit per dimension, candidates are
+    ranked by Hamming distance and the best rerank ones re-scored with the float features,
+    read from features or, if given, through fetch_features.
+    """
+
+    def __init__(
+        self,
+        codes: np.ndarray,
+        features: Optional[np.ndarray] = None,
+        fetch_features: Optional[Callable[[np.ndarray], np.ndarray]] = None,
+        rerank: int = 1000,
+        block_size: int = 1 << 16,
+    ):
+        if features is None and fetch_features is None:
+            raise ValueError("either features or fetch_features is needed for re-ranking")
+        self._codes = GrowableRows(codes)
         self.features = features
+        self.fetch_features = fetch_features
+        self.rerank = rerank
+        self.block_size = block_size
+
+    @property
+    def codes(self) -> np.ndarray:
+        return self._codes.array
+
+    @staticmethod
+    def encode(features: np.ndarray) -> np.ndarray:
+        return np.packbits(features.reshape(-1, features.shape[-1]) > 0, axis=1)
+
+    @classmethod
+    def from_features(
+        cls,
+        features: np.ndarray,
+        fetch_features: Optional[Callable[[np.ndarray], np.ndarray]] = None,
+        rerank: int = 1000,
+    ) -> "BinaryEngine":
+        """Encode features. Re-ranking reads the in-memory features unless fetch_features is set."""
+        return cls(cls.encode(features), features, fetch_features, rerank)
+
+    def hamming(self, query_feat: np.ndarray) -> np.ndarray:
+        codes = self.codes
+        query_code = self.encode(query_feat)
+        # NOTE xor 8 bytes at a time when the codes allow it
+        word = np.uint64 if codes.shape[1] % 8 == 0 else np.uint8
+        query_code = query_code.view(word)
+        dist = np.empty(len(codes), dtype=np.int64)
+        for start in range(0, len(codes), self.block_size):
+            block = codes[start : start + self.block_size].view(word)
+            dist[start : start + len(block)] = popcount_rows(np.bitwise_xor(block, query_code))
+        return dist
+
+    def search(self, query_feat: np.ndarray, top_k: int) -> tuple[np.ndarray, np.ndarray]:
+        query_feat = query_feat.reshape(-1)
+        n_bits = self.codes.shape[1] * 8
+        rows = select_top_k_counts(n_bits - self.hamming(query_feat), max(top_k, self.rerank))
+        if self.fetch_features is not None:
+            scores = self.fetch_features(rows) @ query_feat
+        else:
+            scores = self.features[rows] @ query_feat
+        sort_idx = select_top_k(scores, top_k)
+        return rows[sort_idx], scores[sort_idx]
+
+    def add(self, features: np.ndarray, index_features: Optional[np.ndarray]) -> None:
+        self._codes.append(self.encode(features))
+        if index_features is not None:
+            self.features = index_features
+
+    def compact(self, keep: np.ndarray, index_features: Optional[np.ndarray]) -> "BinaryEngine":
+        return BinaryEngine(
+            self.codes[keep], index_features, self.fetch_features, self.rerank, self.block_size
+        )
+
+
+class PackedIds(Sequence[str]):
+    """Read-only list of image ids backed by a fixed-width bytes array (e.g. memory-mapped)."""
+
+    def __init__(self, ids: np.ndarray):
+        self.ids = ids
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, i: Union[int, slice]) -> Union[str, list[str]]:
+        if isinstance(i, slice):
+            # NOTE ids are hex digests, decoded by numpy in one pass
+            return self.ids[i].astype(str).tolist()
+        return self.ids[i].decode()
+
+
+class GrowableIds(Sequence[str]):
+    """
+    Image ids with amortized O(1) appends: the initial ids (e.g. PackedIds of a snapshot) are
+    kept as they are and new ids go to a list. Shallow copies share that list and only read up
+    to their own length, so appends past it do not change them.
+    """
+
+    def __init__(self, ids: Sequence[str]):
+        self.ids = ids
+        self.appended: list[str] = []
+        self.n_ids = len(ids)
+
+    def __len__(self) -> int:
+        return self.n_ids
+
+    def __getitem__(self, i: Union[int, slice]) -> Union[str, list[str]]:
+        n_initial = len(self.ids)
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.n_ids)
+            if step != 1:
+                return [self[j] for j in range(start, stop, step)]
+            appended = self.appended[max(start - n_initial, 0) : max(stop - n_initial, 0)]
+            return [*self.ids[start : min(stop, n_initial)], *appended]
+        if i < 0:
+            i += self.n_ids
+        if not 0 <= i < self.n_ids:
+            raise IndexError(i)
+        return self.ids[i] if i < n_initial else self.appended[i - n_initial]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self[:])
+
+    def extend(self, img_ids: Iterable[str]) -> None:
+        self.appended.extend(img_ids)
+        self.n_ids = len(self.ids) + len(self.appended)
+
+
+def to_epoch(timestamp: datetime) -> int:
+    """Seconds since the epoch, naive (EXIF) timestamps being read as UTC like numpy does."""
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return int(np.datetime64(timestamp, "s").astype(np.int64))
+
+
+def build_tag_postings(
+    tag_ids: np.ndarray, tag_offsets: np.ndarray, n_tags: int, start: int = 0
+) -> list[np.ndarray]:
+    """
+    Invert per-image tag ids in CSR form (the tags of row i are
+    tag_ids[tag_offsets[i] : tag_offsets[i + 1]]) into sorted int32 posting arrays, one per tag.
+    Rows are numbered from start.
+    """
+    n_rows = len(tag_offsets) - 1
+    rows = np.repeat(np.arange(start, start + n_rows, dtype=np.int32), np.diff(tag_offsets))
+    # NOTE a stable sort keeps the rows of every tag sorted
+    order = np.argsort(tag_ids, kind="stable")
+    splits = np.cumsum(np.bincount(tag_ids, minlength=n_tags))[:-1]
+    return np.split(rows[order], splits)
+
+
+class CompositeIndex:
+    def __init__(
+        self,
+        img_ids: Sequence[str],
+        tag_vocab: dict[str, int],
+        tag_ids: np.ndarray,
+        tag_offsets: np.ndarray,
+        features: np.ndarray,
+        tag_postings: Optional[list[np.ndarray]] = None,
+        timestamps: Optional[np.ndarray] = None,
+        clip_engine: Optional[ClipEngine] = None,
+    ):
+        self._img_ids = GrowableIds(img_ids)
+        # NOTE tags of row i, as ids into tag_vocab: tag_ids[tag_offsets[i] : tag_offsets[i + 1]]
+        self.tag_vocab = tag_vocab
+        self._tag_ids = GrowableRows(tag_ids)
+        self._tag_offsets = GrowableRows(tag_offsets)
+        # NOTE inverted index: tag_postings[tag_vocab[tag]] holds the sorted rows tagged with tag,
+        # as of the last compaction
+        if tag_postings is None:
+            tag_postings = build_tag_postings(tag_ids, tag_offsets, len(tag_vocab))
+        self.tag_postings = tag_postings
+        # NOTE rows added since the last compaction, per tag id, which merges them into
+        # tag_postings (see _tag_rows)
+        self._added_postings: dict[int, GrowableRows] = {}
+        # NOTE compressed bitmaps of the posting lists, built when a tag filter first uses them
+        self._tag_bitmaps: dict[int, Bitmap] = {}
+        self._features = None if features is None else GrowableRows(features)
+        # NOTE int64 epoch seconds per row
+        if timestamps is None:
+            timestamps = np.full(len(img_ids), NO_TIMESTAMP, dtype=np.int64)
+        self._timestamps = GrowableRows(timestamps)
+        # NOTE structures built by the first query needing them: "time_index" (sorted timestamps
+        # and their rows), "months" (month of every row, months since 1970-01), "facets" (of the
+        # whole collection, as (version, facets)) and "max_norm" (largest feature norm). add and
+        # compact replace the dict, so searches on an older view never store stale entries
+        self._cache: dict = {}
+        # NOTE when set, CLIP queries use this approximate engine instead of a full scan
+        self.clip_engine = clip_engine
+        # NOTE removed rows are only tombstoned until the next compaction
+        self._deleted = GrowableRows(np.zeros(len(img_ids), dtype=bool))
+        self.n_deleted = 0
+        self._row_of: Optional[dict[str, int]] = None
+        # NOTE bumped on every change of the indexed images
+        self.version = 0
+        # NOTE held by writers, and by searches only while taking a view (see _view)
+        self._lock = threading.RLock()
+
+    @property
+    def img_ids(self) -> GrowableIds:
+        return self._img_ids
+
+    @property
+    def features(self) -> Optional[np.ndarray]:
+        return None if self._features is None else self._features.array
+
+    @property
+    def deleted(self) -> np.ndarray:
+        return self._deleted.array
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self._timestamps.array
+
+    @property
+    def tag_ids(self) -> np.ndarray:
+        return self._tag_ids.array
+
+    @property
+    def tag_offsets(self) -> np.ndarray:
+        return self._tag_offsets.array
+
+    def add(
+        self,
+        img_ids: list[str],
+        tags: list[Iterable[str]],
+        features: np.ndarray,
+        timestamps: Optional[list[Optional[datetime]]] = None,
+    ) -> None:
+        """
+        Append images to the index. Images already indexed are replaced: their old row is
+        tombstoned. features are needed even when the index does not keep them, for the engine.
+        """
+        with self._lock:
+            row_of = self._get_row_of()
+            self._tombstone([row_of[img_id] for img_id in img_ids if img_id in row_of])
+            start = len(self.img_ids)
+            # NOTE rows are only appended past the end of the arrays, which views do not see
+            features = np.asarray(features, dtype=np.float32).reshape(len(img_ids), -1)
+            if self._features is not None:
+                self._features.append(features)
+            self._deleted.append(np.zeros(len(img_ids), dtype=bool))
+            timestamps = timestamps or [None] * len(img_ids)
+            self._timestamps.append(
+                np.array([NO_TIMESTAMP if t is None else to_epoch(t) for t in timestamps])
+            )
+            tag_vocab, tag_ids, tag_offsets = self._encode_tags(tags)
+            self._tag_offsets.append(self.tag_offsets[-1] + tag_offsets[1:])
+            self._tag_ids.append(tag_ids)
+
+            # NOTE new rows go to the per-tag added rows, whole posting lists are not copied
+            new_rows = np.arange(start, start + len(img_ids), dtype=np.int32)
+            new_rows = np.repeat(new_rows, np.diff(tag_offsets))
+            order = np.argsort(tag_ids, kind="stable")
+            changed, firsts = np.unique(tag_ids[order], return_index=True)
+            changed = changed.tolist()
+            for tag_id, rows in zip(changed, np.split(new_rows[order], firsts[1:])):
+                self._added_postings.setdefault(tag_id, GrowableRows(rows[:0])).append(rows)
+            # NOTE searches add bitmaps without holding the lock, so loop over a copy
+            self._tag_bitmaps = {
+                tag_id: bitmap
+                for tag_id, bitmap in dict(self._tag_bitmaps).items()
+                if tag_id not in changed
+            }
+            self._img_ids.extend(img_ids)
+            self.tag_vocab = tag_vocab
+            row_of.update((img_id, row) for row, img_id in enumerate(img_ids, start))
+
+            max_norm = self._cache.get("max_norm")
+            self._cache = {}
+            if max_norm is not None and len(features):
+                new_norm = float(np.linalg.norm(features, axis=1).max())
+                self._cache["max_norm"] = max(max_norm, new_norm)
+            if self.clip_engine is not None:
+                self.clip_engine.add(features, self.features)
+            self.version += 1
+
+    def _encode_tags(
+        self, tags: list[Iterable[str]]
+    ) -> tuple[dict[str, int], np.ndarray, np.ndarray]:
+        """
+        Vocabulary extended with the unknown tags (a copy, if there are any), and tag ids and
+        offsets (CSR) of new images.
+        """
+        new_tags = {tag for img_tags in tags for tag in img_tags} - self.tag_vocab.keys()
+        if len(self.tag_vocab) + len(new_tags) > np.iinfo(TAG_ID_DTYPE).max + 1:
+            raise ValueError("too many distinct tags for the tag id type")
+        tag_vocab = dict(self.tag_vocab) if new_tags else self.tag_vocab
+        tag_ids, lengths = [], []
+        for img_tags in tags:
+            img_tag_ids = {tag_vocab.setdefault(tag, len(tag_vocab)) for tag in img_tags}
+            tag_ids.extend(img_tag_ids)
+            lengths.append(len(img_tag_ids))
+        tag_ids = np.array(tag_ids, dtype=TAG_ID_DTYPE)
+        return tag_vocab, tag_ids, np.cumsum([0, *lengths], dtype=np.int64)
+
+    def remove(self, img_ids: Iterable[str]) -> int:
+        """Tombstone images, which searches skip from now on. Returns how many were removed."""
+        with self._lock:
+            row_of = self._get_row_of()
+            rows = [row_of.pop(img_id) for img_id in img_ids if img_id in row_of]
+            self._tombstone(rows)
+            self.version += 1
+            return len(rows)
+
+    def compact(self) -> bool:
+        """
+        Drop tombstoned rows and renumber the rest, and merge the rows added since the last
+        compaction into the posting lists. The new arrays are built without holding the lock,
+        so searches keep running; returns False (and changes nothing) if the index was modified
+        meanwhile.
+        """
+        with self._lock:
+            version, n_deleted = self.version, self.n_deleted
+            img_ids, features, tag_postings = self.img_ids, self.features, self.tag_postings
+            added_postings = {tag_id: rows.array for tag_id, rows in self._added_postings.items()}
+            n_tags, timestamps = len(self.tag_vocab), self.timestamps
+            tag_ids, tag_offsets = self.tag_ids, self.tag_offsets
+            keep = ~self.deleted
+            clip_engine = self.clip_engine
+        if not n_deleted and not added_postings:
+            return True
+
+        empty = np.empty(0, dtype=np.int32)
+        tag_postings = [*tag_postings, *[empty] * (n_tags - len(tag_postings))]
+        for tag_id, rows in added_postings.items():
+            tag_postings[tag_id] = np.concatenate([tag_postings[tag_id], rows])
+        if not n_deleted:
+            with self._lock:
+                if self.version != version:
+                    return False
+                self.tag_postings = tag_postings
+                self._added_postings = {}
+            return True
+
+        new_rows = (np.cumsum(keep) - 1).astype(np.int32)
+        kept_rows = np.flatnonzero(keep)
+        img_ids = img_ids[: len(keep)]
+        new_img_ids = [img_ids[i] for i in kept_rows]
+        new_postings = [new_rows[postings[keep[postings]]] for postings in tag_postings]
+        tag_lengths = np.diff(tag_offsets)
+        new_tag_ids = tag_ids[np.repeat(keep, tag_lengths)]
+        new_tag_offsets = np.cumsum([0, *tag_lengths[keep]], dtype=np.int64)
+        new_features = None if features is None else features[kept_rows]
+        if clip_engine is not None:
+            clip_engine = clip_engine.compact(keep, new_features)
+
+        with self._lock:
+            if self.version != version:
+                return False
+            self._img_ids = GrowableIds(new_img_ids)
+            self.tag_postings = new_postings
+            self._added_postings = {}
+            self._tag_ids = GrowableRows(new_tag_ids)
+            self._tag_offsets = GrowableRows(new_tag_offsets)
+            self._tag_bitmaps = {}
+            self._features = None if new_features is None else GrowableRows(new_features)
+            self._timestamps = GrowableRows(timestamps[kept_rows])
+            # NOTE the largest norm of the remaining rows is still a valid bound; searches add
+            # entries without holding the lock, so loop over a copy
+            cache = dict(self._cache)
+            self._cache = {key: value for key, value in cache.items() if key == "max_norm"}
+            self.clip_engine = clip_engine
+            self._deleted = GrowableRows(np.zeros(len(new_img_ids), dtype=bool))
+            self.n_deleted = 0
+            self._row_of = None
+            self.version += 1
+        return True
+
+    def compact_async(self) -> threading.Thread:
+        """Run compact in a background thread."""
+        thread = threading.Thread(target=self.compact, daemon=True)
+        thread.start()
+        return thread
+
+    def shard(self, start: int, stop: int) -> "CompositeIndex":
+        """Sub-index over rows [start, stop), sharing the arrays of this one where possible."""
+        img_ids = self.img_ids
+        if isinstance(img_ids.ids, PackedIds) and stop <= len(img_ids.ids):
+            img_ids = PackedIds(img_ids.ids.ids[start:stop])
+        else:
+            img_ids = img_ids[start:stop]
+        tag_postings = []
+        for tag_id in range(len(self.tag_vocab)):
+            postings = self._tag_rows(tag_id)
+            lo, hi = np.searchsorted(postings, [start, stop])
+            tag_postings.append(postings[lo:hi] - np.int32(start))
+        features = None if self.features is None else self.features[start:stop]
+        lo, hi = self.tag_offsets[start], self.tag_offsets[stop]
+        index = CompositeIndex(
+            img_ids,
+            self.tag_vocab,
+            self.tag_ids[lo:hi],
+            self.tag_offsets[start : stop + 1] - lo,
+            features,
+            tag_postings,
+            self.timestamps[start:stop],
+        )
+        index._tombstone(np.flatnonzero(self.deleted[start:stop]).tolist())
+        return index
+
+    def _get_row_of(self) -> dict[str, int]:
+        if self._row_of is None:
+            img_ids = self.img_ids[:]
+            # NOTE replaced images keep their id on their tombstoned row, the live row comes later
+            self._row_of = dict(zip(img_ids, range(len(img_ids))))
+            for row in np.flatnonzero(self.deleted).tolist():
+                if self._row_of[img_ids[row]] == row:
+                    del self._row_of[img_ids[row]]
+        return self._row_of
+
+    def _tombstone(self, rows: list[int]) -> None:
+        rows = np.array(rows, dtype=np.int64)
+        rows = rows[~self.deleted[rows]]
+        if not len(rows):
+            return
+        # NOTE copy-on-write, views keep the previous tombstones (see _view)
+        deleted = self.deleted.copy()
+        deleted[rows] = True
+        self._deleted = GrowableRows(deleted)
+        self.n_deleted += len(rows)
+
+    def _view(self) -> "CompositeIndex":
+        """
+        Shallow copy of the index as it is now, which a search can read without holding the
+        lock while other threads add or remove images. Writers only append past the end of the
+        arrays, ids and added posting rows, which the copy does not read, and replace the other
+        containers they change.
+        """
+        with self._lock:
+            view = copy.copy(self)
+            view._img_ids = copy.copy(self._img_ids)
+            view._features = None if self._features is None else GrowableRows(self.features)
+            view._tag_ids = GrowableRows(self.tag_ids)
+            view._tag_offsets = GrowableRows(self.tag_offsets)
+            view._timestamps = GrowableRows(self.timestamps)
+            view._deleted = GrowableRows(self.deleted)
+            return view
+
+    def save(self, snapshot_dir: str, watermark: dict) -> None:
+        """
+        Save the index as flat .npy files plus a manifest carrying the database watermark, so
+        it can be memory-mapped by load. The snapshot is written to a new versioned directory,
+        and snapshot_dir is a symlink switched to it atomically, so processes saving or loading
+        at the same time always see a complete snapshot.
+        """
+        if self.n_deleted:
+            raise ValueError("compact the index before saving it")
+        snapshot_dir = os.path.abspath(snapshot_dir)
+        version_dir = f"{snapshot_dir}.v{time.time_ns()}-{os.getpid()}"
+        os.makedirs(version_dir)
+        features = np.ascontiguousarray(self.features, dtype=np.float32)
+        np.save(os.path.join(version_dir, "features.npy"), features)
+        np.save(os.path.join(version_dir, "timestamps.npy"), self.timestamps)
+        img_ids = self.img_ids
+        if isinstance(img_ids.ids, PackedIds) and len(img_ids) == len(img_ids.ids):
+            img_ids = img_ids.ids.ids
+        np.save(os.path.join(version_dir, "img_ids.npy"), np.asarray(img_ids[:], dtype="S"))
+        np.save(os.path.join(version_dir, "tag_ids.npy"), self.tag_ids)
+        np.save(os.path.join(version_dir, "tag_offsets.npy"), self.tag_offsets)
+        tag_postings = [self._tag_rows(tag_id) for tag_id in range(len(self.tag_vocab))]
+        lengths = [len(postings) for postings in tag_postings]
+        postings = np.concatenate([np.empty(0, dtype=np.int32), *tag_postings])
+        np.save(os.path.join(version_dir, "tag_postings.npy"), postings.astype(np.int32))
+        np.save(os.path.join(version_dir, "posting_offsets.npy"), np.cumsum([0, *lengths]))
+        manifest = {
+            "version": SNAPSHOT_VERSION,
+            "n_images": len(self.img_ids),
+            "tags": sorted(self.tag_vocab, key=self.tag_vocab.__getitem__),
+            "watermark": watermark,
+        }
+        with open(os.path.join(version_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+
+        previous = os.path.realpath(snapshot_dir) if os.path.islink(snapshot_dir) else None
+        if os.path.isdir(snapshot_dir) and not os.path.islink(snapshot_dir):
+            # NOTE snapshots used to be saved as plain directories
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+        tmp_link = f"{snapshot_dir}.link{os.getpid()}"
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.basename(version_dir), tmp_link)
+        os.replace(tmp_link, snapshot_dir)
+        if previous is not None:
+            # NOTE versions older than the replaced one can go once no load can still be reading
+            # them; the replaced one is kept, other processes may have just resolved it
+            parent, name = os.path.split(snapshot_dir)
+            for other in os.listdir(parent):
+                other_dir = os.path.join(parent, other)
+                if (
+                    other.startswith(f"{name}.v")
+                    and other < os.path.basename(previous)
+                    and time.time() - os.path.getmtime(other_dir) > SNAPSHOT_GRACE_SECONDS
+                ):
+                    shutil.rmtree(other_dir, ignore_errors=True)
+
+    @classmethod
+    def load(
+        cls, snapshot_dir: str, watermark: Optional[dict] = None
+    ) -> Optional["CompositeIndex"]:
+        """
+        Memory-map a snapshot saved by save. Returns None if there is no snapshot, or if it was
+        saved at another watermark than the given one.
+        """
+        for _ in range(3):
+            # NOTE resolve the symlink once, so that every file comes from the same version
+            version_dir = os.path.realpath(snapshot_dir)
+            try:
+                return cls._load_version(version_dir, watermark)
+            except FileNotFoundError:
+                # NOTE unless the version was removed by concurrent saves meanwhile, there is
+                # no snapshot
+                if os.path.realpath(snapshot_dir) == version_dir:
+                    return None
+        return None
+
+    @classmethod
+    def _load_version(
+        cls, version_dir: str, watermark: Optional[dict]
+    ) -> Optional["CompositeIndex"]:
+        with open(os.path.join(version_dir, "manifest.json"), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest["version"] != SNAPSHOT_VERSION:
+            return None
+        if watermark is not None and manifest["watermark"] != watermark:
+            return None
+
+        def load_array(name: str) -> np.ndarray:
+            return np.load(os.path.join(version_dir, f"{name}.npy"), mmap_mode="r")
+
+        postings, offsets = load_array("tag_postings"), load_array("posting_offsets")
+        tag_postings = [postings[offsets[i] : offsets[i + 1]] for i in range(len(offsets) - 1)]
+        tag_vocab = {tag: tag_id for tag_id, tag in enumerate(manifest["tags"])}
+        img_ids = PackedIds(load_array("img_ids"))
+        return cls(
+            img_ids,
+            tag_vocab,
+            load_array("tag_ids"),
+            load_array("tag_offsets"),
+            load_array("features"),
+            tag_postings,
+            load_array("timestamps"),
+        )
 
     def find_knn_combined(
+        self,
+        query_tags: Iterable[str],
+        query_feat: np.ndarray,
+        top_k: int,
+        min_overlap: int = 0,
+        min_candidates: Optional[int] = None,
+        tag_filter: Optional[str] = None,
+        time_range: Optional[TimeRange] = None,
+    ) -> list[tuple[str, float]]:
+        """
+        With min_overlap > 0, only the images sharing at least min_overlap tags with the query
+        are CLIP-scored (1 is the union of the query tags' images, len(query_tags) their
+        intersection). If that leaves fewer than min_candidates (default: top_k) images, all
+        images are scored instead. With a tag_filter (see filter_tags) or a time_range (see
+        filter_time_range), only the matching images are ranked.
+        """
+        if not isinstance(query_tags, set):
+            query_tags = set(query_tags)
+        index = self._view()
+        rows = index._filter_rows(tag_filter, time_range)
+        if rows is not None:
+            return index._find_knn_filtered(rows, query_tags, query_feat, top_k)
+        if min_overlap > 0 and index.features is not None:
+            candidates, counts = index.get_candidates(query_tags, min_overlap)
+            if len(candidates) >= (top_k if min_candidates is None else min_candidates):
+                clip_sim = index.features[candidates] @ query_feat.reshape(-1)
+                avg_sim = (counts / len(query_tags) + clip_sim) / 2
+                sort_idx = select_top_k(avg_sim, top_k)
+                return [(index.img_ids[candidates[i]], avg_sim[i]) for i in sort_idx]
+        if index.clip_engine is not None:
+            return index._find_knn_combined_approx(query_tags, query_feat, top_k)
+        rows, scores = index._find_knn_combined_threshold(query_tags, query_feat, top_k)
+        return [(index.img_ids[i], score) for i, score in zip(rows, scores)]
+
+    def find_knn_tags(
+        self,
+        query_tags: Iterable[str],
+        top_k: int,
+        tag_filter: Optional[str] = None,
+        time_range: Optional[TimeRange] = None,
+    ) -> list[tuple[str, float]]:
+        if not isinstance(query_tags, set):
+            query_tags = set(query_tags)
+        index = self._view()
+        rows = index._filter_rows(tag_filter, time_range)
+        if rows is not None:
+            return index._find_knn_filtered(rows, query_tags, None, top_k)
+        rows, counts = index.get_tag_counts(query_tags)
+        sort_idx = select_top_k_counts(counts, top_k)
+        top_ids = [(index.img_ids[rows[i]], counts[i] / len(query_tags)) for i in sort_idx]
+        if len(top_ids) < top_k:
+            # NOTE pad with images without any overlap, as a full ranking would
+            n_missing = top_k - len(top_ids)
+            n_candidates = min(len(index.img_ids), n_missing + len(rows) + index.n_deleted)
+            candidates = np.flatnonzero(~index.deleted[:n_candidates])
+            top_ids.extend(
+                (index.img_ids[i], 0.0) for i in np.setdiff1d(candidates, rows)[:n_missing]
+            )
+        return top_ids
+
+    def find_knn_clip(
+        self,
+        query_feat: np.ndarray,
+        top_k: int,
+        tag_filter: Optional[str] = None,
+        time_range: Optional[TimeRange] = None,
+    ) -> list[tuple[str, float]]:
+        index = self._view()
+        rows = index._filter_rows(tag_filter, time_range)
+        if rows is not None:
+            return index._find_knn_filtered(rows, None, query_feat, top_k)
+        if index.clip_engine is not None:
+            rows, clip_sim = index._engine_search(query_feat, top_k)
+            return [(index.img_ids[i], score) for i, score in zip(rows[:top_k], clip_sim)]
+        clip_sim = index.get_clip_sim(query_feat)
+        if index.n_deleted:
+            clip_sim[index.deleted] = -np.inf
+        sort_idx = select_top_k(clip_sim, top_k)
+        return [(index.img_ids[i], clip_sim[i]) for i in sort_idx if not index.deleted[i]]
+
+    def filter_tags(self, tag_query: str) -> np.ndarray:
+        """
+        Sorted rows of the images matching a boolean tag query such as
+        `beach AND dog AND NOT people` (see parse_tag_query), using bitmap set operations.
+        """
+        node = parse_tag_query(tag_query)
+        index = self._view()
+        bitmap = evaluate_tag_query(
+            node, index._tag_bitmap, lambda: Bitmap.full(len(index.img_ids))
+        )
+        rows = bitmap.to_rows()
+        if index.n_deleted:
+            rows = rows[~index.deleted[rows]]
+        return rows
+
+    def filter_time_range(
+        self, start: Optional[datetime] = None, end: Optional[datetime] = None
+    ) -> np.ndarray:
+        """
+        Sorted rows of the images taken in [start, end), found by binary search in the sorted
+        timestamps. Images without a timestamp never match.
+        """
+        index = self._view()
+        if "time_index" not in index._cache:
+            order = np.argsort(index.timestamps, kind="stable")
+            index._cache["time_index"] = (index.timestamps[order], order)
+        sorted_times, order = index._cache["time_index"]
+        if start is None:
+            lo = np.searchsorted(sorted_times, NO_TIMESTAMP, side="right")
+        else:
+            lo = np.searchsorted(sorted_times, to_epoch(start))
+        hi = len(sorted_times) if end is None else np.searchsorted(sorted_times, to_epoch(end))
+        rows = np.sort(order[lo:hi])
+        if index.n_deleted:
+            rows = rows[~index.deleted[rows]]
+        return rows
+
+    def facets(self, mask: Optional[np.ndarray] = None) -> Facets:
+        """
+        Tag and month counts of the images selected by mask (a boolean array over rows, or an
+        array of rows), or of the whole collection, counted in one pass over the tag id and
+        month arrays. Counts of the whole collection are kept until the index changes.
+        """
+        index = self._view()
+        cached = index._cache.get("facets")
+        if mask is None and cached is not None and cached[0] == index.version:
+            return cached[1]
+        selected = ~index.deleted
+        if mask is not None:
+            mask = np.asarray(mask)
+            if mask.dtype != bool:
+                rows, mask = mask, np.zeros(len(selected), dtype=bool)
+                mask[rows] = True
+            selected &= mask
+        if "months" not in index._cache:
+            months = index.timestamps.astype("datetime64[s]").astype("datetime64[M]")
+            index._cache["months"] = months.astype(np.int64)
+
+        tag_selected = np.repeat(selected, np.diff(index.tag_offsets))
+        tag_counts = np.bincount(index.tag_ids[tag_selected], minlength=len(index.tag_vocab))
+        tags = sorted(index.tag_vocab, key=index.tag_vocab.__getitem__)
+        order = np.argsort(-tag_counts, kind="stable")
+        tag_facets = {tags[i]: int(tag_counts[i]) for i in order if tag_counts[i]}
+
+        months = index._cache["months"][selected]
+        months = months[months != NO_TIMESTAMP]
+        month_facets = {}
+        if len(months):
+            first = months.min()
+            month_counts = np.bincount(months - first)
+            month_facets = {
+                str(np.datetime64(int(first + i), "M")): int(count)
+                for i, count in enumerate(month_counts)
+                if count
+            }
+        facets = (tag_facets, month_facets)
+        if mask is None:
+            index._cache["facets"] = (index.version, facets)
+        return facets
+
+    def _filter_rows(
+        self, tag_filter: Optional[str], time_range: Optional[TimeRange]
+    ) -> Optional[np.ndarray]:
+        """Rows passing the given filters, or None without any filter."""
+        rows = self.filter_tags(tag_filter) if tag_filter else None
+        if time_range is not None:
+            time_rows = self.filter_time_range(*time_range)
+            if rows is not None:
+                time_rows = np.intersect1d(rows, time_rows, assume_unique=True)
+            rows = time_rows
+        return rows
+
+    def _tag_bitmap(self, tag: str) -> Bitmap:
+        tag_id = self.tag_vocab.get(tag)
+        if tag_id is None:
+            return Bitmap({})
+        if tag_id not in self._tag_bitmaps:
+            self._tag_bitmaps[tag_id] = Bitmap.from_rows(self._tag_rows(tag_id))
+        return self._tag_bitmaps[tag_id]
+
+    def _tag_rows(self, tag_id: int) -> np.ndarray:
+        """Sorted rows tagged with a tag: its posting list, then the rows added since."""
+        postings = self.tag_postings[tag_id] if tag_id < len(self.tag_postings) else None
+        added = self._added_postings.get(tag_id)
+        if added is None:
+            return np.empty(0, dtype=np.int32) if postings is None else postings
+        # NOTE add appends to the added rows in place, so they are read under the lock, and only
+        # the rows this index (or view) holds are kept
+        with self._lock:
+            added = added.array
+        added = added[: np.searchsorted(added, len(self.img_ids))]
+        return added if postings is None else np.concatenate([postings, added])
+
+    def _find_knn_filtered(
+        self,
+        rows: np.ndarray,
+        query_tags: Optional[set[str]],
+        query_feat: Optional[np.ndarray],
+        top_k: int,
+    ) -> list[tuple[str, float]]:
+        """Rank only the given sorted rows, e.g. those matching a tag filter."""
+        scores = np.zeros(len(rows), dtype=np.float32)
+        if query_feat is not None:
+            if self.features is None:
+                # NOTE without float features only the engine's candidates can be ranked, so
+                # a selective filter may return fewer than top_k images
+                candidates, clip_sim = self._engine_search(
+                    query_feat, top_k * COMBINED_CANDIDATES_FACTOR
+                )
+                matched = np.isin(candidates, rows)
+                rows, scores = candidates[matched], clip_sim[matched]
+            elif len(rows) * 4 < len(self.img_ids):
+                scores = self.features[rows] @ query_feat.reshape(-1)
+            else:
+                # NOTE most rows match: mask the dense scores rather than gathering features
+                scores = self.get_clip_sim(query_feat)[rows]
+        if query_tags:
+            tag_overlap = self.get_tag_overlap(query_tags, rows)
+            scores = tag_overlap if query_feat is None else (scores + tag_overlap) / 2
+        sort_idx = select_top_k(scores, top_k)
+        return [(self.img_ids[rows[i]], scores[i]) for i in sort_idx]
+
+    def _find_knn_combined_threshold(
+        self, query_tags: Iterable[str], query_feat: np.ndarray, top_k: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Exact combined search with Fagin's threshold algorithm: images are scored one tag
+        overlap bucket at a time, from the highest overlap down, and the search stops once an
+        upper bound of the score of every unseen image is below the current k-th score.
+        CLIP similarities are bounded by the feature norms.
+        """
+        if not isinstance(query_tags, set):
+            query_tags = set(query_tags)
+        query_feat = query_feat.reshape(-1)
+        tag_rows, counts = self.get_tag_counts(query_tags)
+        n_tags = max(len(query_tags), 1)
+        # NOTE small slack so float rounding never makes a bound too tight
+        clip_bound = float(np.linalg.norm(query_feat)) * self._get_max_norm() + 1e-5
+        best_rows = np.empty((1, 0), dtype=np.int64)
+        best_scores = np.empty((1, 0), dtype=np.float32)
+
+        def kth_score() -> float:
+            return best_scores[0, -1] if best_scores.shape[1] >= top_k else -np.inf
+
+        def score_rows(rows: np.ndarray, overlap: float) -> None:
+            nonlocal best_rows, best_scores
+            scores = (overlap + self.features[rows] @ query_feat) / 2
+            best_rows, best_scores = merge_top_k(
+                best_rows, best_scores, rows[None, :], scores[None, :], top_k
+            )
+
+        for count in np.unique(counts)[::-1]:
+            if (count / n_tags + clip_bound) / 2 < kth_score():
+                break
+            score_rows(tag_rows[counts == count].astype(np.int64), count / n_tags)
+        else:
+            # NOTE images without any matching tag are usually most of the collection, so they
+            # are scored with a dense GEMV block by block rather than by gathering their features
+            if clip_bound / 2 >= kth_score():
+                skip = self.deleted.copy()
+                skip[tag_rows] = True
+                for start in range(0, len(skip), 65536):
+                    stop = start + 65536
+                    scores = (self.features[start:stop] @ query_feat) / 2
+                    scores[skip[start:stop]] = -np.inf
+                    top = select_top_k(scores, top_k)
+                    top = top[scores[top] > -np.inf]
+                    best_rows, best_scores = merge_top_k(
+                        best_rows, best_scores, (start + top)[None, :], scores[top][None, :], top_k
+                    )
+        return best_rows[0], best_scores[0]
+
+    def _get_max_norm(self) -> float:
+        """Largest feature norm, computed once and then kept up to date by add."""
+        if "max_norm" not in self._cache:
+            self._cache["max_norm"] = max(
+                (float(np.linalg.norm(block, axis=1).max()) for block in self._blocks()),
+                default=0.0,
+            )
+        return self._cache["max_norm"]
+
+    def _blocks(self, block_size: int = 65536) -> Iterable[np.ndarray]:
+        for start in range(0, len(self.img_ids), block_size):
+            yield self.features[start : start + block_size]
+
+    def _engine_search(self, query_feat: np.ndarray, top_k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Search the CLIP engine, over-fetching to make up for tombstoned rows."""
+        # NOTE engines are updated in place by add, so they are searched under the lock, and may
+        # return rows added after this view was taken
+        with self._lock:
+            rows, clip_sim = self.clip_engine.search(query_feat, top_k + self.n_deleted)
+        live = rows < len(self.deleted)
+        if self.n_deleted:
+            live[live] = ~self.deleted[rows[live]]
+        return rows[live], clip_sim[live]
+
+    def _find_knn_combined_approx(
         self, query_tags: Iterable[str], query_feat: np.ndarray, top_k: int
     ) -> list[tuple[str, float]]:
-        tag_overlap = self.get_tag_overlap(query_tags)
-        tag_overlap = np.array(tag_overlap)
-        clip_sim = self.get_clip_sim(query_feat)
+        rows, clip_sim = self._engine_search(query_feat, top_k * COMBINED_CANDIDATES_FACTOR)
+        tag_overlap = self.get_tag_overlap(query_tags, rows)
         avg_sim = (tag_overlap + clip_sim) / 2
-        sort_idx = np.argsort(-avg_sim)
-        return [(self.img_ids[i], avg_sim[i]) for i in sort_idx[:top_k]]
+        sort_idx = select_top_k(avg_sim, top_k)
+        return [(self.img_ids[rows[i]], avg_sim[i]) for i in sort_idx]
+
+    def find_knn_clip_batch(
+        self, query_feats: np.ndarray, top_k: int, block_size: Optional[int] = None
+    ) -> list[list[tuple[str, float]]]:
+        """Same as find_knn_clip, for a (Q, D) matrix of queries."""
+        return self._find_knn_batch(None, query_feats, top_k, block_size)
+
+    def find_knn_combined_batch(
+        self,
+        query_tags: list[Iterable[str]],
+        query_feats: np.ndarray,
+        top_k: int,
+        block_size: Optional[int] = None,
+    ) -> list[list[tuple[str, float]]]:
+        """Same as find_knn_combined, for a list of tag sets and a (Q, D) matrix of queries."""
+        return self._find_knn_batch(query_tags, query_feats, top_k, block_size)
+
+    def find_knn_tags_batch(
+        self, query_tags: list[Iterable[str]], top_k: int
+    ) -> list[list[tuple[str, float]]]:
+        # NOTE tag queries only touch their posting lists, there is no full scan to share
+        return [self.find_knn_tags(tags, top_k) for tags in query_tags]
+
+    def _find_knn_batch(
+        self,
+        query_tags: Optional[list[Iterable[str]]],
+        query_feats: np.ndarray,
+        top_k: int,
+        block_size: Optional[int],
+    ) -> list[list[tuple[str, float]]]:
+        """
+        Score all queries at once with one GEMM per block of rows, keeping a running top_k per
+        query, so memory is bounded by the block size rather than by the collection size.
+        """
+        query_feats = query_feats.reshape(len(query_feats), -1)
+        n_queries = len(query_feats)
+        index = self._view()
+        if index.clip_engine is not None:
+            if query_tags is None:
+                return [index.find_knn_clip(feat, top_k) for feat in query_feats]
+            return [
+                index.find_knn_combined(tags, feat, top_k)
+                for tags, feat in zip(query_tags, query_feats)
+            ]
+
+        tag_counts = []
+        for tags in query_tags or []:
+            tags = set(tags)
+            rows, counts = index.get_tag_counts(tags)
+            tag_counts.append((rows, counts / max(len(tags), 1)))
+
+        n_rows = len(index.img_ids)
+        # NOTE keep the (Q, block) score matrix around 64 MB
+        block_size = block_size or max(1024, (1 << 24) // max(n_queries, 1))
+        best_rows = np.empty((n_queries, 0), dtype=np.int64)
+        best_scores = np.empty((n_queries, 0), dtype=np.float32)
+        for start in range(0, n_rows, block_size):
+            stop = min(start + block_size, n_rows)
+            scores = query_feats @ index.features[start:stop].T
+            for i, (rows, overlap) in enumerate(tag_counts):
+                lo, hi = np.searchsorted(rows, [start, stop])
+                scores[i] *= 0.5
+                scores[i, rows[lo:hi] - start] += overlap[lo:hi] / 2
+            if index.n_deleted:
+                scores[:, index.deleted[start:stop]] = -np.inf
+            block_rows = np.broadcast_to(np.arange(start, stop), scores.shape)
+            best_rows, best_scores = merge_top_k(best_rows, best_scores, block_rows, scores, top_k)
+
+        return [
+            [(index.img_ids[i], score) for i, score in zip(rows, scores) if score > -np.inf]
+            for rows, scores in zip(best_rows, best_scores)
+        ]
+
+    def get_tag_counts(self, query_tags: Iterable[str]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Count tag overlap using only the posting lists of the query tags.
 
-    def find_knn_tags(self, query_tags: Iterable[str], top_k: int) -> list[tuple[str, float]]:
-        tag_overlap = self.get_tag_overlap(query_tags)
-        sort_idx = argsort(tag_overlap, ascending=False)
-        return [(self.img_ids[i], tag_overlap[i]) for i in sort_idx[:top_k]]
+        Returns the rows with at least one matching tag (sorted) and their number of matching
+        tags. Images without any matching tag are never touched.
+        """
+        tag_ids = [self.tag_vocab[tag] for tag in set(query_tags) if tag in self.tag_vocab]
+        postings = [self._tag_rows(tag_id) for tag_id in tag_ids]
+        if not postings:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64)
+        if len(postings) == 1:
+            rows, counts = postings[0], np.ones(len(postings[0]), dtype=np.int64)
+        else:
+            rows, counts = np.unique(np.concatenate(postings), return_counts=True)
+        if self.n_deleted:
+            live = ~self.deleted[rows]
+            rows, counts = rows[live], counts[live]
+        return rows, counts
 
-    def find_knn_clip(self, query_feat: np.ndarray, top_k: int) -> list[tuple[str, float]]:
-        clip_sim = self.get_clip_sim(query_feat)
-        sort_idx = np.argsort(-clip_sim)
-        return [(self.img_ids[i], clip_sim[i]) for i in sort_idx[:top_k]]
+    def get_candidates(
+        self, query_tags: Iterable[str], min_overlap: int = 1
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Rows sharing at least min_overlap tags with the query, and their overlap counts."""
+        rows, counts = self.get_tag_counts(query_tags)
+        keep = counts >= min_overlap
+        return rows[keep], counts[keep]
 
-    def get_tag_overlap(self, query_tags: Iterable[str]) -> list[float]:
+    def get_tag_overlap(
+        self, query_tags: Iterable[str], rows: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """Tag overlap fraction for every image, or only for the given rows."""
         if not isinstance(query_tags, set):
             query_tags = set(query_tags)
-        return [len(query_tags & tags) / len(query_tags) for tags in self.tags]
+        if rows is None:
+            tag_rows, counts = self.get_tag_counts(query_tags)
+            tag_overlap = np.zeros(len(self.img_ids), dtype=np.float32)
+            tag_overlap[tag_rows] = counts / len(query_tags)
+            return tag_overlap
+        # NOTE few rows: read their own tag ids rather than the query tags' posting lists
+        is_query_tag = np.zeros(len(self.tag_vocab), dtype=bool)
+        is_query_tag[[self.tag_vocab[tag] for tag in query_tags if tag in self.tag_vocab]] = True
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.tag_offsets[rows]
+        lengths = self.tag_offsets[rows + 1] - starts
+        ends = np.cumsum(lengths)
+        n_elements = ends[-1] if len(ends) else 0
+        elements = np.arange(n_elements) + np.repeat(starts - ends + lengths, lengths)
+        counts = np.bincount(
+            np.repeat(np.arange(len(rows)), lengths),
+            weights=is_query_tag[self.tag_ids[elements]],
+            minlength=len(rows),
+        )
+        if self.n_deleted:
+            counts[self.deleted[rows]] = 0
+        return (counts / len(query_tags)).astype(np.float32)
 
     def get_clip_sim(self, query_feat: np.ndarray) -> np.ndarray:
         return (query_feat.reshape(1, -1) @ self.features.T)[0, :]
@@ -0,0 +1,161 @@
+"""
+Inverted-file (IVF) approximate nearest neighbour index for CLIP features.
+"""
+
+import json
+import os
+from typing import Optional
+
+import numpy as np
+
+from src.index import select_top_k
+
+
+def assign_clusters(
+    data: np.ndarray, centroids: np.ndarray, block_size: int = 65536
+) -> np.ndarray:
+    """Label each row of data with its most similar centroid (by inner product)."""
+    labels = np.empty(len(data), dtype=np.int32)
+    for start in range(0, len(data), block_size):
+        block = data[start : start + block_size]
+        labels[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return labels
+
+
+def assign_l2(data: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Label each row of data with its nearest centroid (by euclidean distance)."""
+    dist = (centroids**2).sum(axis=1) - 2 * data @ centroids.T
+    return np.argmin(dist, axis=1)
+
+
+def train_kmeans(
+    data: np.ndarray,
+    n_clusters: int,
+    n_iter: int = 20,
+    max_samples: Optional[int] = 256,
+    seed: int = 0,
+    spherical: bool = True,
+) -> np.ndarray:
+    """
+    Spherical k-means by default: points go to the centroid with the highest inner product and
+    centroids are kept normalized, since CLIP features are compared by inner product. With
+    spherical=False, plain (euclidean) k-means, e.g. for PQ codebooks. At most max_samples
+    points per cluster are used for training (all of them if None).
+    """
+    rng = np.random.default_rng(seed)
+    if max_samples is not None and len(data) > n_clusters * max_samples:
+        data = data[np.sort(rng.choice(len(data), n_clusters * max_samples, replace=False))]
+    data = np.asarray(data, dtype=np.float32)
+    assign = assign_clusters if spherical else assign_l2
+    centroids = data[rng.choice(len(data), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        labels = assign(data, centroids)
+        counts = np.bincount(labels, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, data)
+        # NOTE re-seed empty clusters with random points
+        empty = counts == 0
+        sums[empty] = data[rng.choice(len(data), empty.sum())]
+        counts[empty] = 1
+        if spherical:
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+        else:
+            centroids = sums / counts[:, None]
+    return centroids
+
+
+class IVFIndex:
+    """
+    Coarse-quantized index: every row of features is stored in the list of its nearest
+    centroid, and only the nprobe lists closest to the query are scanned at query time.
+    """
+
+    def __init__(
+        self, centroids: np.ndarray, lists: list[np.ndarray], features: np.ndarray, nprobe: int = 8
+    ):
+        self.centroids = centroids
+        self.lists = lists
+        self.features = features
+        self.nprobe = nprobe
+
+    @classmethod
+    def train(
+        cls,
+        features: np.ndarray,
+        n_lists: Optional[int] = None,
+        nprobe: int = 8,
+        n_iter: int = 20,
+        seed: int = 0,
+    ) -> "IVFIndex":
+        if n_lists is None:
+            n_lists = int(4 * np.sqrt(len(features)))
+        n_lists = max(1, min(n_lists, len(features)))
+        centroids = train_kmeans(features, n_lists, n_iter=n_iter, seed=seed)
+        labels = assign_clusters(features, centroids)
+        rows = np.argsort(labels, kind="stable").astype(np.int32)
+        splits = np.cumsum(np.bincount(labels, minlength=n_lists))[:-1]
+        return cls(centroids, np.split(rows, splits), features, nprobe)
+
+    def save(self, path: str, watermark: dict) -> None:
+        """Save the centroids and lists, trained on the features of the database at watermark."""
+        counts = np.array([len(rows) for rows in self.lists], dtype=np.int64)
+        rows = np.concatenate([np.empty(0, dtype=np.int32), *self.lists]).astype(np.int32)
+        # NOTE write through a file object so numpy does not append a .npz suffix to path, then
+        # rename, so that a process starting meanwhile never loads a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                centroids=self.centroids,
+                counts=counts,
+                rows=rows,
+                nprobe=self.nprobe,
+                watermark=json.dumps(watermark),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, features: np.ndarray, watermark: dict) -> Optional["IVFIndex"]:
+        """Load saved centroids and lists, or None if they were saved at another watermark."""
+        with np.load(path) as data:
+            if json.loads(str(data["watermark"])) != watermark:
+                return None
+            splits = np.cumsum(data["counts"])[:-1]
+            lists = np.split(data["rows"], splits)
+            return cls(data["centroids"], lists, features, int(data["nprobe"]))
+
+    @classmethod
+    def load_or_train(
+        cls, path: str, features: np.ndarray, watermark: dict, **params
+    ) -> "IVFIndex":
+        """Load the index saved at path, (re)training and saving it if missing or stale."""
+        index = cls.load(path, features, watermark) if os.path.exists(path) else None
+        if index is None:
+            index = cls.train(features, **params)
+            index.save(path, watermark)
+        return index
+
+    def search(
+        self, query_feat: np.ndarray, top_k: int, nprobe: Optional[int] = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Return the rows of the top_k most similar features among the probed lists."""
+        query_feat = query_feat.reshape(-1)
+        probe = select_top_k(self.centroids @ query_feat, nprobe or self.nprobe)
+        rows = np.concatenate([self.lists[i] for i in probe])
+        scores = self.features[rows] @ query_feat
+        sort_idx = select_top_k(scores, top_k)
+        return rows[sort_idx], scores[sort_idx]
+
+    def add(self, features: np.ndarray, index_features: Optional[np.ndarray]) -> None:
+        """Append new rows to the list of their nearest centroid (centroids are not retrained)."""
+        start = len(index_features) - len(features)
+        labels = assign_clusters(features, self.centroids)
+        for label in np.unique(labels):
+            new_rows = start + np.flatnonzero(labels == label).astype(np.int32)
+            self.lists[label] = np.concatenate([self.lists[label], new_rows])
+        self.features = index_features
+
+    def compact(self, keep: np.ndarray, index_features: Optional[np.ndarray]) -> "IVFIndex":
+        new_rows = (np.cumsum(keep) - 1).astype(np.int32)
+        lists = [new_rows[rows[keep[rows]]] for rows in self.lists]
+        return IVFIndex(self.centroids, lists, index_features, self.nprobe)
@@ -0,0 +1,134 @@
+"""
+Product quantization (PQ) of CLIP features, scored with asymmetric distance computation (ADC).
+"""
+
+from typing import Callable, Optional
+
+import numpy as np
+
+from src.db import StorageDB
+from src.index import CompositeIndex, GrowableRows, select_top_k
+from src.ivf import assign_l2, train_kmeans
+
+
+class ProductQuantizer:
+    """
+    Splits vectors into n_subspaces chunks and replaces each chunk with the id of its nearest
+    centroid in that sub-space, so a vector is stored as n_subspaces bytes.
+    """
+
+    def __init__(self, codebooks: np.ndarray):
+        # NOTE shape (n_subspaces, n_centroids, sub-space dim)
+        self.codebooks = codebooks
+
+    @property
+    def n_subspaces(self) -> int:
+        return self.codebooks.shape[0]
+
+    @classmethod
+    def train(
+        cls, data: np.ndarray, n_subspaces: int = 64, n_centroids: int = 256, n_iter: int = 20
+    ) -> "ProductQuantizer":
+        if data.shape[1] % n_subspaces:
+            raise ValueError(f"dimension {data.shape[1]} not divisible by {n_subspaces}")
+        if n_centroids > 256:
+            raise ValueError("codes are stored as uint8, use at most 256 centroids")
+        n_centroids = min(n_centroids, len(data))
+        chunks = data.reshape(len(data), n_subspaces, -1).astype(np.float32)
+        codebooks = np.stack(
+            [
+                train_kmeans(chunks[:, m], n_centroids, n_iter, None, seed=m, spherical=False)
+                for m in range(n_subspaces)
+            ]
+        )
+        return cls(codebooks)
+
+    def encode(self, data: np.ndarray) -> np.ndarray:
+        chunks = data.reshape(len(data), self.n_subspaces, -1)
+        codes = np.empty((len(data), self.n_subspaces), dtype=np.uint8)
+        for m in range(self.n_subspaces):
+            codes[:, m] = assign_l2(chunks[:, m], self.codebooks[m])
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        chunks = self.codebooks[np.arange(self.n_subspaces), codes]
+        return chunks.reshape(len(codes), -1)
+
+    def lookup_table(self, query_feat: np.ndarray) -> np.ndarray:
+        """Inner product of each query chunk with every centroid of its sub-space."""
+        chunks = query_feat.reshape(self.n_subspaces, 1, -1)
+        return (self.codebooks * chunks).sum(axis=2)
+
+    def score(self, codes: np.ndarray, query_feat: np.ndarray, block_size: int = 65536):
+        """Approximate inner products of the query with every encoded vector (ADC)."""
+        lut = self.lookup_table(query_feat).ravel()
+        offsets = np.arange(self.n_subspaces) * self.codebooks.shape[1]
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), block_size):
+            block = codes[start : start + block_size]
+            scores[start : start + len(block)] = lut[block + offsets].sum(axis=1)
+        return scores
+
+
+class PQEngine:
+    """
+    CLIP engine over PQ codes. If fetch_features is given, the best rerank candidates are
+    re-scored exactly with their float features (e.g. read from the database).
+    """
+
+    def __init__(
+        self,
+        pq: ProductQuantizer,
+        codes: np.ndarray,
+        fetch_features: Optional[Callable[[np.ndarray], np.ndarray]] = None,
+        rerank: int = 100,
+    ):
+        self.pq = pq
+        self._codes = GrowableRows(codes)
+        self.fetch_features = fetch_features
+        self.rerank = rerank
+
+    @property
+    def codes(self) -> np.ndarray:
+        return self._codes.array
+
+    @classmethod
+    def from_db(
+        cls,
+        db: StorageDB,
+        index: CompositeIndex,
+        n_subspaces: int = 64,
+        n_centroids: int = 256,
+        n_train: int = 65536,
+        rerank: int = 100,
+    ) -> "PQEngine":
+        """
+        Train the codebooks on a sample of the features table and encode it batch by batch,
+        so the float features are never all in memory.
+        """
+        pq = ProductQuantizer.train(db.sample_features(n_train), n_subspaces, n_centroids)
+        codes = np.empty((len(index.img_ids), n_subspaces), dtype=np.uint8)
+        row = 0
+        for batch_ids, features in db.iter_features():
+            if batch_ids != index.img_ids[row : row + len(batch_ids)]:
+                raise ValueError("features table does not match the index rows")
+            codes[row : row + len(batch_ids)] = pq.encode(features)
+            row += len(batch_ids)
+        return cls(pq, codes, db.features_fetcher(index) if rerank else None, rerank)
+
+    def search(self, query_feat: np.ndarray, top_k: int) -> tuple[np.ndarray, np.ndarray]:
+        query_feat = query_feat.reshape(-1)
+        scores = self.pq.score(self.codes, query_feat)
+        if self.fetch_features is None:
+            rows = select_top_k(scores, top_k)
+            return rows, scores[rows]
+        rows = select_top_k(scores, max(top_k, self.rerank))
+        scores = self.fetch_features(rows) @ query_feat
+        sort_idx = select_top_k(scores, top_k)
+        return rows[sort_idx], scores[sort_idx]
+
+    def add(self, features: np.ndarray, index_features: Optional[np.ndarray]) -> None:
+        self._codes.append(self.pq.encode(features))
+
+    def compact(self, keep: np.ndarray, index_features: Optional[np.ndarray]) -> "PQEngine":
+        return PQEngine(self.pq, self.codes[keep], self.fetch_features, self.rerank)
@@ -0,0 +1,154 @@
+"""
+Out-of-core exact search: the feature store is scanned in fixed-size blocks while a running
+top-k heap is kept, so memory use does not grow with the number of images.
+"""
+
+import heapq
+import os
+from collections import Counter
+from typing import Callable, Iterable, Iterator, Optional
+
+import numpy as np
+
+from src.bitmap import TagQuery, match_tag_query, parse_tag_query
+from src.db import StorageDB
+from src.index import NO_TIMESTAMP, Facets, PackedIds, TimeRange, select_top_k, to_epoch
+
+# NOTE blocks of (img_ids, features, tags, timestamps), tags being None when the source has none
+Block = tuple[list[str], np.ndarray, Optional[list[set[str]]], np.ndarray]
+
+
+def iter_snapshot_blocks(snapshot_dir: str, block_size: int = 65536) -> Iterator[Block]:
+    """Read the features of an index snapshot (see CompositeIndex.save) block by block."""
+    snapshot_dir = os.path.realpath(snapshot_dir)
+    features = np.load(os.path.join(snapshot_dir, "features.npy"), mmap_mode="r")
+    img_ids = PackedIds(np.load(os.path.join(snapshot_dir, "img_ids.npy"), mmap_mode="r"))
+    timestamps = np.load(os.path.join(snapshot_dir, "timestamps.npy"), mmap_mode="r")
+    for start in range(0, len(features), block_size):
+        # NOTE copy the block, so its pages can be dropped once it has been scored
+        block = np.array(features[start : start + block_size])
+        stop = start + len(block)
+        yield img_ids[start:stop], block, None, timestamps[start:stop]
+
+
+class ScanIndex:
+    """
+    Exact search without an in-memory index, exposing the find_knn_* methods of CompositeIndex.
+    Queries are slower, since every one of them reads the whole feature store.
+    """
+
+    def __init__(self, blocks: Callable[[], Iterable[Block]]):
+        self.blocks = blocks
+        # NOTE same as CompositeIndex.version, but the feature store is never modified through
+        # this class
+        self.version = 0
+
+    @classmethod
+    def from_db(cls, db: StorageDB, block_size: int = 65536) -> "ScanIndex":
+        return cls(lambda: db.iter_rows(block_size))
+
+    @classmethod
+    def from_snapshot(cls, snapshot_dir: str, block_size: int = 65536) -> "ScanIndex":
+        """CLIP-only scans over the flat features file of an index snapshot."""
+        return cls(lambda: iter_snapshot_blocks(snapshot_dir, block_size))
+
+    def find_knn_combined(
+        self,
+        query_tags: Iterable[str],
+        query_feat: np.ndarray,
+        top_k: int,
+        min_overlap: int = 0,
+        min_candidates: Optional[int] = None,
+        tag_filter: Optional[str] = None,
+        time_range: Optional[TimeRange] = None,
+    ) -> list[tuple[str, float]]:
+        # NOTE every image is read anyway, so candidate generation is not used (as if it fell
+        # back to scoring all images)
+        return self._scan(set(query_tags), query_feat, top_k, tag_filter, time_range)
+
+    def find_knn_tags(
+        self,
+        query_tags: Iterable[str],
+        top_k: int,
+        tag_filter: Optional[str] = None,
+        time_range: Optional[TimeRange] = None,
+    ) -> list[tuple[str, float]]:
+        return self._scan(set(query_tags), None, top_k, tag_filter, time_range)
+
+    def find_knn_clip(
+        self,
+        query_feat: np.ndarray,
+        top_k: int,
+        tag_filter: Optional[str] = None,
+        time_range: Optional[TimeRange] = None,
+    ) -> list[tuple[str, float]]:
+        return self._scan(None, query_feat, top_k, tag_filter, time_range)
+
+    def facets(self, mask: Optional[np.ndarray] = None) -> Facets:
+        """Same as CompositeIndex.facets, counted while reading every image."""
+        if mask is not None:
+            mask = np.asarray(mask)
+            if mask.dtype != bool:
+                mask = np.isin(np.arange(mask.max(initial=-1) + 1), mask)
+        tag_counts, month_counts = Counter(), Counter()
+        row = 0
+        for img_ids, _, tags, timestamps in self.blocks():
+            selected = np.ones(len(img_ids), dtype=bool)
+            if mask is not None:
+                block_mask = mask[row : row + len(img_ids)]
+                selected[:] = False
+                selected[: len(block_mask)] = block_mask
+            row += len(img_ids)
+            if tags is not None:
+                for i in np.flatnonzero(selected):
+                    tag_counts.update(tags[i])
+            months = np.asarray(timestamps[selected]).astype("datetime64[s]")
+            months = months[~np.isnat(months)].astype("datetime64[M]")
+            month_counts.update(str(month) for month in months)
+        return dict(tag_counts.most_common()), dict(sorted(month_counts.items()))
+
+    def _scan(
+        self,
+        query_tags: Optional[set[str]],
+        query_feat: Optional[np.ndarray],
+        top_k: int,
+        tag_filter: Optional[str] = None,
+        time_range: Optional[TimeRange] = None,
+    ) -> list[tuple[str, float]]:
+        node: Optional[TagQuery] = parse_tag_query(tag_filter) if tag_filter else None
+        if time_range is not None:
+            start, end = time_range
+            start = NO_TIMESTAMP + 1 if start is None else to_epoch(start)
+            end = None if end is None else to_epoch(end)
+        # NOTE min-heap of (score, -row, img_id): on equal scores the lowest row wins
+        heap: list[tuple[float, int, str]] = []
+        row = 0
+        for img_ids, features, tags, timestamps in self.blocks():
+            if (query_tags is not None or node is not None) and tags is None:
+                raise ValueError("this feature store has no tags")
+            scores = np.zeros(len(img_ids), dtype=np.float32)
+            if query_feat is not None:
+                scores += features @ query_feat.reshape(-1)
+            if query_tags:
+                overlap = [len(query_tags & img_tags) / len(query_tags) for img_tags in tags]
+                overlap = np.array(overlap, dtype=np.float32)
+                scores = overlap if query_feat is None else (scores + overlap) / 2
+            if node is not None:
+                # NOTE no index to evaluate the filter with, so it is matched image by image
+                matched = np.array([match_tag_query(node, img_tags) for img_tags in tags], bool)
+                scores[~matched] = -np.inf
+            if time_range is not None:
+                in_range = timestamps >= start
+                if end is not None:
+                    in_range &= timestamps < end
+                scores[~in_range] = -np.inf
+            for i in select_top_k(scores, top_k):
+                if scores[i] == -np.inf:
+                    break
+                item = (float(scores[i]), -(row + int(i)), img_ids[i])
+                if len(heap) < top_k:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
+            row += len(img_ids)
+        return [(img_id, score) for score, _, img_id in sorted(heap, reverse=True)]
@@ -0,0 +1,210 @@
+"""
+Multi-process sharded search: the index is split by row range across worker processes, every
+query is sent to all shards and their top-k results are merged.
+"""
+
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import threading
+from collections import Counter
+from concurrent.futures import Future
+from multiprocessing.connection import Connection
+from typing import Any, Iterable, Optional
+
+import numpy as np
+
+from src.index import CompositeIndex, Facets, TimeRange
+
+
+def _serve_shard(conn: Connection, snapshot_dir: str, start: int, stop: int) -> None:
+    # NOTE every worker maps the same snapshot files, so the OS shares their pages
+    index = CompositeIndex.load(snapshot_dir).shard(start, stop)
+    conn.send((True, None))
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        request_id, method, args = request
+        try:
+            conn.send((request_id, True, getattr(index, method)(*args)))
+        except Exception as exc:
+            conn.send((request_id, False, exc))
+    conn.close()
+
+
+def merge_results(
+    results: list[list[tuple[str, float]]], top_k: int
+) -> list[tuple[str, float]]:
+    """
+    Merge per-shard results (each sorted best first) into the global top_k. heapq.merge is
+    stable, so ties keep the shard (i.e. row) order, as an unsharded search would.
+    """
+    merged = heapq.merge(*results, key=lambda result: -result[1])
+    return [result for _, result in zip(range(top_k), merged)]
+
+
+def merge_facets(results: list[Facets]) -> Facets:
+    """Sum per-shard facets, keeping tags most frequent first and months chronological."""
+    tag_counts, month_counts = Counter(), Counter()
+    for tag_facets, month_facets in results:
+        tag_counts.update(tag_facets)
+        month_counts.update(month_facets)
+    return dict(tag_counts.most_common()), dict(sorted(month_counts.items()))
+
+
+class ShardedIndex:
+    """
+    Search front end over an index snapshot (see CompositeIndex.save) split into n_shards row
+    ranges, each one served by its own process. Exposes the find_knn_* methods of CompositeIndex.
+    """
+
+    def __init__(self, snapshot_dir: str, n_shards: Optional[int] = None):
+        # NOTE resolve the snapshot symlink once, so all shards serve the same version even if
+        # a new one is saved meanwhile (see CompositeIndex.save)
+        snapshot_dir = os.path.realpath(snapshot_dir)
+        with open(os.path.join(snapshot_dir, "manifest.json"), "r", encoding="utf-8") as f:
+            n_images = json.load(f)["n_images"]
+        n_shards = max(1, min(n_shards or os.cpu_count() or 1, n_images))
+        bounds = np.linspace(0, n_images, n_shards + 1).astype(int)
+        self.bounds = bounds
+        # NOTE same as CompositeIndex.version, but snapshots are read-only
+        self.version = 0
+        # NOTE spawn, since the app process holds threads and torch state that should not be forked
+        ctx = multiprocessing.get_context("spawn")
+        self.conns: list[Connection] = []
+        self.processes = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(
+                target=_serve_shard,
+                args=(child_conn, snapshot_dir, int(start), int(stop)),
+                daemon=True,
+            )
+            process.start()
+            # NOTE the worker holds its end now, so it gets EOF once the worker exits
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.processes.append(process)
+        for conn in self.conns:
+            conn.recv()
+        # NOTE app sessions run in threads, and several of their queries can be in flight: sends
+        # to a pipe are serialized by its lock, and one thread per pipe routes the replies to
+        # the futures of their requests, by request id
+        self._send_locks = [threading.Lock() for _ in self.conns]
+        self._pending: dict[tuple[int, int], Future] = {}
+        self._request_ids = itertools.count()
+        self._readers = [
+            threading.Thread(target=self._read_replies, args=(shard, conn), daemon=True)
+            for shard, conn in enumerate(self.conns)
+        ]
+        for reader in self._readers:
+            reader.start()
+
+    def _read_replies(self, shard: int, conn: Connection) -> None:
+        while True:
+            try:
+                request_id, ok, result = conn.recv()
+            except (EOFError, OSError):
+                break
+            future = self._pending.pop((request_id, shard))
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+        for key in [key for key in list(self._pending) if key[1] == shard]:
+            self._pending.pop(key).set_exception(EOFError(f"shard {shard} exited"))
+
+    def _scatter(
+        self, method: str, *args, shard_args: Optional[list[tuple]] = None
+    ) -> list[Any]:
+        """Call method on every shard, with args or with shard_args[i] for the i-th shard."""
+        request_id = next(self._request_ids)
+        futures = []
+        # NOTE send to every shard before waiting, so they all work in parallel
+        for i, conn in enumerate(self.conns):
+            future = Future()
+            self._pending[(request_id, i)] = future
+            with self._send_locks[i]:
+                conn.send((request_id, method, args if shard_args is None else shard_args[i]))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def find_knn_combined(
+        self,
+        query_tags: Iterable[str],
+        query_feat: np.ndarray,
+        top_k: int,
+        min_overlap: int = 0,
+        min_candidates: Optional[int] = None,
+        tag_filter: Optional[str] = None,
+        time_range: Optional[TimeRange] = None,
+    ) -> list[tuple[str, float]]:
+        # NOTE every shard applies the min_candidates fallback to its own candidates
+        results = self._scatter(
+            "find_knn_combined",
+            set(query_tags),
+            query_feat,
+            top_k,
+            min_overlap,
+            min_candidates,
+            tag_filter,
+            time_range,
+        )
+        return merge_results(results, top_k)
+
+    def find_knn_tags(
+        self,
+        query_tags: Iterable[str],
+        top_k: int,
+        tag_filter: Optional[str] = None,
+        time_range: Optional[TimeRange] = None,
+    ) -> list[tuple[str, float]]:
+        results = self._scatter("find_knn_tags", set(query_tags), top_k, tag_filter, time_range)
+        return merge_results(results, top_k)
+
+    def find_knn_clip(
+        self,
+        query_feat: np.ndarray,
+        top_k: int,
+        tag_filter: Optional[str] = None,
+        time_range: Optional[TimeRange] = None,
+    ) -> list[tuple[str, float]]:
+        results = self._scatter("find_knn_clip", query_feat, top_k, tag_filter, time_range)
+        return merge_results(results, top_k)
+
+    def find_knn_clip_batch(
+        self, query_feats: np.ndarray, top_k: int
+    ) -> list[list[tuple[str, float]]]:
+        shard_results = self._scatter("find_knn_clip_batch", query_feats, top_k)
+        return [merge_results(results, top_k) for results in zip(*shard_results)]
+
+    def find_knn_combined_batch(
+        self, query_tags: list[Iterable[str]], query_feats: np.ndarray, top_k: int
+    ) -> list[list[tuple[str, float]]]:
+        query_tags = [set(tags) for tags in query_tags]
+        shard_results = self._scatter("find_knn_combined_batch", query_tags, query_feats, top_k)
+        return [merge_results(results, top_k) for results in zip(*shard_results)]
+
+    def facets(self, mask: Optional[np.ndarray] = None) -> Facets:
+        if mask is None:
+            return merge_facets(self._scatter("facets"))
+        mask = np.asarray(mask)
+        if mask.dtype != bool:
+            rows, mask = mask, np.zeros(self.bounds[-1], dtype=bool)
+            mask[rows] = True
+        shard_args = [(mask[start:stop],) for start, stop in zip(self.bounds[:-1], self.bounds[1:])]
+        return merge_facets(self._scatter("facets", shard_args=shard_args))
+
+    def close(self) -> None:
+        for conn, send_lock in zip(self.conns, self._send_locks):
+            with send_lock:
+                conn.send(None)
+        for process in self.processes:
+            process.join()
+        for reader in self._readers:
+            reader.join()
+        for conn in self.conns:
+            conn.close()
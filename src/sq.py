@@ -0,0 +1,100 @@
+"""
+int8 scalar quantization of CLIP features, with exact float re-ranking.
+"""
+
+from typing import Callable, Optional
+
+import numpy as np
+
+from src.db import StorageDB
+from src.index import CompositeIndex, GrowableRows, select_top_k
+
+
+class Int8Engine:
+    """
+    CLIP engine over features quantized to int8 with a per-dimension scale. If fetch_features
+    is given, the best rerank candidates are re-scored exactly with their float features.
+    """
+
+    def __init__(
+        self,
+        codes: np.ndarray,
+        scale: np.ndarray,
+        fetch_features: Optional[Callable[[np.ndarray], np.ndarray]] = None,
+        rerank: int = 200,
+        block_size: int = 16384,
+    ):
+        self._codes = GrowableRows(codes)
+        self.scale = scale
+        self.fetch_features = fetch_features
+        self.rerank = rerank
+        self.block_size = block_size
+
+    @property
+    def codes(self) -> np.ndarray:
+        return self._codes.array
+
+    @staticmethod
+    def compute_scale(max_abs: np.ndarray) -> np.ndarray:
+        return np.maximum(max_abs, 1e-12).astype(np.float32) / 127
+
+    @staticmethod
+    def quantize(features: np.ndarray, scale: np.ndarray) -> np.ndarray:
+        return np.clip(np.rint(features / scale), -127, 127).astype(np.int8)
+
+    @classmethod
+    def from_features(
+        cls,
+        features: np.ndarray,
+        fetch_features: Optional[Callable[[np.ndarray], np.ndarray]] = None,
+        rerank: int = 200,
+    ) -> "Int8Engine":
+        scale = cls.compute_scale(np.abs(features).max(axis=0))
+        return cls(cls.quantize(features, scale), scale, fetch_features, rerank)
+
+    @classmethod
+    def from_db(cls, db: StorageDB, index: CompositeIndex, rerank: int = 200) -> "Int8Engine":
+        """Quantize the features table in two streaming passes (scale, then codes)."""
+        max_abs = None
+        for _, features in db.iter_features():
+            batch_max = np.abs(features).max(axis=0)
+            max_abs = batch_max if max_abs is None else np.maximum(max_abs, batch_max)
+        scale = cls.compute_scale(max_abs)
+        codes = np.empty((len(index.img_ids), len(scale)), dtype=np.int8)
+        row = 0
+        for batch_ids, features in db.iter_features():
+            if batch_ids != index.img_ids[row : row + len(batch_ids)]:
+                raise ValueError("features table does not match the index rows")
+            codes[row : row + len(batch_ids)] = cls.quantize(features, scale)
+            row += len(batch_ids)
+        return cls(codes, scale, db.features_fetcher(index) if rerank else None, rerank)
+
+    def score(self, query_feat: np.ndarray) -> np.ndarray:
+        """Approximate inner products, one block of codes at a time to bound the float copy."""
+        query_feat = (query_feat.reshape(-1) * self.scale).astype(np.float32)
+        codes = self.codes
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), self.block_size):
+            block = codes[start : start + self.block_size]
+            scores[start : start + len(block)] = block.astype(np.float32) @ query_feat
+        return scores
+
+    def search(self, query_feat: np.ndarray, top_k: int) -> tuple[np.ndarray, np.ndarray]:
+        query_feat = query_feat.reshape(-1)
+        scores = self.score(query_feat)
+        if self.fetch_features is None:
+            rows = select_top_k(scores, top_k)
+            return rows, scores[rows]
+        rows = select_top_k(scores, max(top_k, self.rerank))
+        scores = self.fetch_features(rows) @ query_feat
+        sort_idx = select_top_k(scores, top_k)
+        return rows[sort_idx], scores[sort_idx]
+
+    def add(self, features: np.ndarray, index_features: Optional[np.ndarray]) -> None:
+        """Quantize new rows with the existing scale (values out of range are clipped)."""
+        self._codes.append(self.quantize(features, self.scale))
+
+    def compact(self, keep: np.ndarray, index_features: Optional[np.ndarray]) -> "Int8Engine":
+        return Int8Engine(
+            self.codes[keep], self.scale, self.fetch_features, self.rerank, self.block_size
+        )
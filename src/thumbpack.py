@@ -0,0 +1,146 @@
+"""
+Append-only pack of thumbnails, served as memoryview slices of a memory-mapped file.
+"""
+
+import mmap
+import os
+import threading
+from typing import Iterable, Optional
+
+import numpy as np
+
+# NOTE one fixed-size record per thumbnail; ids are stored as hex, since numpy strips trailing
+# null bytes from "S" fields and raw digests could end with some
+PACK_INDEX_DTYPE = np.dtype(
+    [("id", "S40"), ("offset", "<i8"), ("length", "<i8"), ("extension", "S8")]
+)
+
+
+def merge_runs(runs: list[np.ndarray], records: np.ndarray) -> list[np.ndarray]:
+    """
+    Add records (in append order) to runs: arrays of records sorted by id, oldest first, each
+    one larger than the next. A new run is merged with the runs not larger than it, so every
+    record is copied O(log n) times overall, and there are O(log n) runs to search.
+    """
+    run = records
+    runs = list(runs)
+    while runs and len(runs[-1]) <= len(run):
+        run = np.concatenate([runs.pop(), run])
+    # NOTE stable, so that the first record of an id wins
+    runs.append(run[np.argsort(run["id"], kind="stable")])
+    return runs
+
+
+class ThumbnailPack:
+    """
+    Thumbnails appended to one file (path), with an index file (path + ".idx") of
+    PACK_INDEX_DTYPE records, held in a few numpy arrays sorted by id (see merge_runs). A
+    lookup is a few binary searches and a slice of the memory-mapped pack: no SQLite query and
+    no copy, the OS page cache keeps the hot thumbnails. Readers pick up thumbnails appended
+    since they were opened on their first miss, reading only the new records.
+    """
+
+    def __init__(self, path: str, read_mode: bool = True, fsync: bool = True):
+        self.path = os.path.abspath(path)
+        self.index_path = f"{self.path}.idx"
+        self.read_mode = read_mode
+        self.fsync = fsync
+        # NOTE (sorted runs of records, view of the pack), swapped at once on refresh, since
+        # app sessions look thumbnails up from several threads
+        self._state: tuple[list[np.ndarray], memoryview] = ([], memoryview(b""))
+        self._n_records = 0
+        self._lock = threading.Lock()
+        if not read_mode:
+            self._data_file = open(self.path, "ab")
+            self._index_file = open(self.index_path, "ab")
+        self.refresh()
+
+    def refresh(self) -> None:
+        """Reload the index and remap the pack if records were appended."""
+        with self._lock:
+            if not os.path.exists(self.index_path):
+                return
+            # NOTE ignore a partially written last record
+            n_records = os.path.getsize(self.index_path) // PACK_INDEX_DTYPE.itemsize
+            if n_records == self._n_records:
+                return
+            records = np.fromfile(
+                self.index_path,
+                dtype=PACK_INDEX_DTYPE,
+                count=n_records - self._n_records,
+                offset=self._n_records * PACK_INDEX_DTYPE.itemsize,
+            )
+            with open(self.path, "rb") as f:
+                # NOTE the previous map is not closed, results may still hold slices of it
+                view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            self._state = (merge_runs(self._state[0], records), view)
+            self._n_records = n_records
+
+    def _lookup(self, img_id: str) -> Optional[tuple[str, memoryview]]:
+        runs, view = self._state
+        key = img_id.encode()
+        # NOTE oldest run first, so that the first record of an id wins
+        for records in runs:
+            ids = records["id"]
+            i = int(np.searchsorted(ids, key))
+            if i < len(ids) and ids[i] == key:
+                record = records[i]
+                offset = int(record["offset"])
+                return record["extension"].decode(), view[offset : offset + int(record["length"])]
+        return None
+
+    def __contains__(self, img_id: str) -> bool:
+        return self.get(img_id) is not None
+
+    def get(self, img_id: str) -> Optional[tuple[str, memoryview]]:
+        """(extension, thumbnail bytes) of an image, or None if it is not packed."""
+        result = self._lookup(img_id)
+        if result is None:
+            n_records = self._n_records
+            self.refresh()
+            if self._n_records != n_records:
+                result = self._lookup(img_id)
+        return result
+
+    def add(self, thumbnails: Iterable[tuple[str, bytes, str]]) -> None:
+        """Append (img_id, thumbnail bytes, extension) that are not packed yet."""
+        if self.read_mode:
+            raise ValueError("cannot add thumbnails to a pack opened in read mode")
+        records = []
+        added = set()
+        offset = self._data_file.seek(0, os.SEEK_END)
+        max_extension = PACK_INDEX_DTYPE["extension"].itemsize
+        for img_id, small_img_bytes, extension in thumbnails:
+            # NOTE extensions that do not fit in a record are left to the database; the lookup
+            # sees every record written so far, since add ends with a refresh
+            if (
+                img_id in added
+                or len(extension.encode()) > max_extension
+                or self._lookup(img_id) is not None
+            ):
+                continue
+            added.add(img_id)
+            self._data_file.write(small_img_bytes)
+            records.append((img_id, offset, len(small_img_bytes), extension))
+            offset += len(small_img_bytes)
+        if not records:
+            return
+        # NOTE the records are only appended once the data they point to is written, so readers
+        # never see a record past the end of the pack
+        self._flush(self._data_file)
+        self._index_file.write(np.array(records, dtype=PACK_INDEX_DTYPE).tobytes())
+        self._flush(self._index_file)
+        self.refresh()
+
+    def _flush(self, f) -> None:
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+    def close(self) -> None:
+        if not self.read_mode:
+            self._data_file.close()
+            self._index_file.close()
+        # NOTE drop the map rather than closing it, results may still hold slices of it
+        self._state = ([], memoryview(b""))
+        self._n_records = 0
@@ -2,18 +2,42 @@ import base64
 import io
 import json
 import math
+from datetime import datetime, time, timedelta
+from hashlib import sha1
 
 import streamlit as st
 import streamlit.components.v1 as components
 import torch
 from PIL import Image, ImageOps
 
+from src.cache import LRUCache
 from src.db import StorageDB
+from src.hnsw import HNSWIndex
+from src.index import BinaryEngine
 from src.inference import create_clip_extractor, create_ram_extractor
+from src.ivf import IVFIndex
+from src.pq import PQEngine
+from src.scan import ScanIndex
+from src.sharding import ShardedIndex
+from src.sq import Int8Engine
 
 MODEL_PATH = "./models/ram_swin_large_14m.pth"
 TAG_FILE_PATH = "./ram/data/ram_tag_list.txt"
 DB_PATH = "./storage.db"
+# NOTE "exact" scans every CLIP vector, "ivf" only the lists closest to the query, "hnsw"
+# walks a graph saved next to the database, while "pq" (64-byte codes) and "int8" keep compressed
+# features in memory instead of the float ones. "binary" pre-filters by Hamming distance of the
+# feature sign bits. "sharded" runs the exact search in N_SHARDS worker processes and "scan"
+# reads the database block by block for every query instead of keeping an index in memory
+CLIP_ENGINE = "exact"
+N_SHARDS = None  # NOTE defaults to the number of cores
+# NOTE when > 0, image queries only CLIP-score the images sharing at least this many tags with
+# the query, unless there are fewer than top_k of them
+MIN_TAG_OVERLAP = 0
+N_FACET_TAGS = 20
+# NOTE results of recent queries are kept, as long as the index does not change
+CACHE_MAX_ENTRIES = 256
+CACHE_MAX_BYTES = 256 << 20
 
 
 @st.cache_resource
@@ -23,16 +47,63 @@ def get_valid_tags(tag_file_path: str) -> set[str]:
 
 
 @st.cache_resource
-def get_searcher(model_path: str, db_path: str, valid_tags: set[str], device):
+def get_searcher(
+    model_path: str, db_path: str, valid_tags: set[str], device, clip_engine: str = "exact"
+):
     clip_img_extractor, clip_txt_extractor = create_clip_extractor(device)
     ram_extractor = create_ram_extractor(model_path, device=device)
     db = StorageDB(db_path, read_mode=True)
-    index = db.create_index()
-
-    def do_search(img_file=None, input_tags=None, text=None, top_k: int = 10):
-        if img_file is None and not input_tags and not text:
+    if clip_engine == "scan":
+        index = ScanIndex.from_db(db)
+    elif clip_engine in ("pq", "int8"):
+        index = db.create_index(load_features=False)
+    else:
+        index = db.load_index(f"{db_path}.index")
+    if clip_engine == "pq":
+        index.clip_engine = PQEngine.from_db(db, index)
+    elif clip_engine == "int8":
+        index.clip_engine = Int8Engine.from_db(db, index)
+    elif clip_engine == "binary":
+        index.clip_engine = BinaryEngine.from_features(index.features)
+    elif clip_engine == "ivf":
+        index.clip_engine = IVFIndex.load_or_train(
+            f"{db_path}.ivf.npz", index.features, db.watermark()
+        )
+    elif clip_engine == "hnsw":
+        index.clip_engine = HNSWIndex.load_or_build(
+            f"{db_path}.hnsw.npz", index.features, index.img_ids
+        )
+    elif clip_engine == "sharded":
+        # NOTE load_index above made sure the snapshot the shards map is up to date
+        index = ShardedIndex(f"{db_path}.index", N_SHARDS)
+
+    cache = LRUCache(CACHE_MAX_ENTRIES, CACHE_MAX_BYTES)
+    cache_version = index.version
+
+    def do_search(
+        img_file=None, input_tags=None, text=None, top_k: int = 10, tag_filter=None, dates=()
+    ):
+        if img_file is None and not input_tags and not text and not tag_filter and not dates:
             return []
 
+        nonlocal cache_version
+        if index.version != cache_version:
+            cache.clear()
+            cache_version = index.version
+        img_hash = sha1(img_file.getvalue()).hexdigest() if img_file is not None else None
+        query_key = (
+            img_hash,
+            tuple(sorted(set(input_tags or []))),
+            text or "",
+            top_k,
+            tag_filter or "",
+            tuple(dates),
+            index.version,
+        )
+        img_info = cache.get(query_key)
+        if img_info is not None:
+            return img_info
+
         tags = set()
         feat, img_feat, txt_feat = None, None, None
         if img_file is not None:
@@ -52,17 +123,32 @@ def get_searcher(model_path: str, db_path: str, valid_tags: set[str], device):
 
         input_tags = set(input_tags or [])
         tags = tags | (input_tags & valid_tags)
+        tag_filter = tag_filter or None
+        time_range = None
+        if dates:
+            # NOTE both dates are included
+            start = datetime.combine(dates[0], time.min)
+            end = datetime.combine(dates[-1], time.min) + timedelta(days=1)
+            time_range = (start, end)
+        filters = {"tag_filter": tag_filter, "time_range": time_range}
         if tags and feat is not None:
-            top_ids = index.find_knn_combined(tags, feat, top_k)
+            top_ids = index.find_knn_combined(
+                tags, feat, top_k, min_overlap=MIN_TAG_OVERLAP, **filters
+            )
         elif not tags and feat is not None:
-            top_ids = index.find_knn_clip(feat, top_k)
+            top_ids = index.find_knn_clip(feat, top_k, **filters)
         else:
-            top_ids = index.find_knn_tags(tags, top_k)
+            top_ids = index.find_knn_tags(tags, top_k, **filters)
 
         img_info = [(img_id, *db.retrieve_small_img(img_id), score) for img_id, score in top_ids]
+        # NOTE the thumbnails make up most of the size of a result
+        n_bytes = sum(len(small_bytes) + 256 for _, _, small_bytes, _ in img_info)
+        cache.put(query_key, img_info, n_bytes)
         return img_info
 
-    return db, do_search
+    # NOTE a scan would read the whole database on every page load to count facets
+    facets = None if clip_engine == "scan" else index.facets
+    return db, do_search, facets
 
 
 # check https://discuss.streamlit.io/t/automatic-download-select-and-download-file-with-single-button-click/15141/4
@@ -125,7 +211,16 @@ def main():
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
     valid_tags = get_valid_tags(TAG_FILE_PATH)
-    db, searcher = get_searcher(MODEL_PATH, DB_PATH, valid_tags, device)
+    db, searcher, facets = get_searcher(MODEL_PATH, DB_PATH, valid_tags, device, CLIP_ENGINE)
+
+    if facets is not None:
+        tag_facets, month_facets = facets()
+        top_tags = list(tag_facets.items())[:N_FACET_TAGS]
+        st.sidebar.subheader("Most frequent tags")
+        st.sidebar.markdown("\n".join(f"- {tag} ({count:,})" for tag, count in top_tags))
+        if month_facets:
+            st.sidebar.subheader("Images per month")
+            st.sidebar.bar_chart({"images": month_facets})
 
     if "page" not in st.session_state:
         st.session_state["page"] = 0
@@ -140,11 +235,17 @@ def main():
     file_upload = st.file_uploader("Upload image:", accept_multiple_files=False)
     tags_selector = st.multiselect("Desired tags", options=sorted(valid_tags))
     txt_descriptor = st.text_input("Text description:", max_chars=256)
+    tag_filter = st.text_input("Tag filter (e.g. beach AND dog AND NOT people):", max_chars=256)
+    dates = st.date_input("Taken between:", value=())
     top_k = st.slider(
         "Number of images to retrieve:", min_value=1, max_value=100, value=items_per_page
     )
 
-    results = searcher(file_upload, tags_selector, txt_descriptor, top_k)
+    try:
+        results = searcher(file_upload, tags_selector, txt_descriptor, top_k, tag_filter, dates)
+    except ValueError as e:
+        st.error(str(e))
+        results = []
     st.session_state["results"] = results
 
     n_pages = math.ceil(len(st.session_state["results"]) / items_per_page)